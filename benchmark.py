@@ -0,0 +1,330 @@
+import http.server
+import urllib.parse
+import contextlib
+import tracemalloc
+import threading
+import itertools
+import argparse
+import tempfile
+import hashlib
+import random
+import json
+import time
+import sys
+import os
+import io
+import re
+
+import numpy as np
+
+import blaster
+import remote_blast
+import ncbi_updater
+from synthetic_data import random_sequence,write_fasta,write_fastq,synthetic_xml,synthetic_volume,read_fasta_queries
+import synthetic_data
+
+# Benchmarks the hot paths of blaster offline, on synthetic sequences and blast xml
+# Local blasts run the stub blastn of synthetic_data, and remote blasts a mock of the NCBI BLAST URL API, so neither needs a db or network
+# Db updates download synthetic volumes from a mock of the NCBI blast db folder, which drops connections to exercise resuming
+# Usage: python benchmark.py [--sequences 200] [--length 500] [--stages parser,xml-parse] [--json results.json]
+
+STAGES = ("parser","parser-fastq","parser-gzip","cache-lookup","xml-parse","formatter","summary-batch","local-batch","remote-async","db-update")
+
+def install_stub_blastn(folder:str):
+    # Writes a blastn into folder which runs synthetic_data.stub_blastn, and puts it first on the PATH
+    script = os.path.abspath(synthetic_data.__file__)
+    if os.name == 'nt':
+        with open(os.path.join(folder,"blastn.bat"),"w") as f:
+            f.write(f'@"{sys.executable}" "{script}" blastn %*\n')
+    else:
+        path = os.path.join(folder,"blastn")
+        with open(path,"w") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" blastn "$@"\n')
+        os.chmod(path,0o755)
+    os.environ["PATH"] = folder+os.pathsep+os.environ["PATH"]
+
+
+class MockBlastServer:
+    # A local stand-in for the NCBI BLAST URL API, searches are ready search_latency seconds after they are submitted,
+    # and every request takes request_latency seconds
+    def __init__(self, search_latency:float=1, request_latency:float=0, hits:int=10, hsps:int=2):
+        server = self
+        self.search_latency = search_latency
+        self.request_latency = request_latency
+        self.hits = hits
+        self.hsps = hsps
+        self.searches:dict[str,tuple[float,str]] = dict()
+        self.rids = itertools.count()
+        self.requests = 0
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            def log_message(self, *args):
+                pass
+            def reply(self, body:str):
+                server.requests += 1
+                time.sleep(server.request_latency)
+                data = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Length",str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def do_POST(self):
+                form = urllib.parse.parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+                rid = f"BENCH{next(server.rids):06d}"
+                server.searches[rid] = (time.monotonic()+server.search_latency,form["QUERY"][0])
+                self.reply(f"<!--QBlastInfoBegin\n    RID = {rid}\n    RTOE = {int(server.search_latency)}\nQBlastInfoEnd\n-->")
+            def do_GET(self):
+                query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+                ready, fasta = server.searches[query["RID"][0]]
+                if query.get("FORMAT_OBJECT") == ["SearchInfo"]:
+                    self.reply(f"QBlastInfoBegin\n    Status={'READY' if time.monotonic() >= ready else 'WAITING'}\nQBlastInfoEnd")
+                else:
+                    self.reply(synthetic_xml(read_fasta_queries(fasta),server.hits,server.hsps))
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1",0),Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/Blast.cgi"
+        threading.Thread(target=self.httpd.serve_forever,daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class MockVolumeServer:
+    # A local stand-in for the NCBI blast db folder, serving the volumes, their .md5 files and the metadata json of a db
+    # Range requests are answered like the NCBI servers do, and if drop_after is set every response is cut off after that many bytes,
+    # so a volume only downloads if the updater resumes from where the connection was dropped
+    def __init__(self, name:str, volumes:dict[str,bytes], drop_after:int|None=None):
+        server = self
+        self.drop_after = drop_after
+        self.files:dict[str,bytes] = dict()
+        self.requests = 0
+        self.ranges = 0
+        self.dropped = 0
+        for fname,data in volumes.items():
+            self.files[fname] = data
+            self.files[fname+".md5"] = f"{hashlib.md5(data).hexdigest()}  {fname}\n".encode()
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                server.requests += 1
+                data = server.files.get(urllib.parse.urlsplit(self.path).path.lstrip("/"))
+                if data is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length","0")
+                    self.end_headers()
+                    return
+                start = 0
+                match = re.fullmatch(r"bytes=(\d+)-",self.headers.get("Range",""))
+                if match is not None:
+                    server.ranges += 1
+                    start = int(match[1])
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header("Content-Range",f"bytes */{len(data)}")
+                        self.send_header("Content-Length","0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range",f"bytes {start}-{len(data)-1}/{len(data)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length",str(len(data)-start))
+                self.end_headers()
+                if server.drop_after is not None and len(data)-start > server.drop_after:
+                    # Sends part of the body and closes the connection, like a download broken off midway
+                    server.dropped += 1
+                    self.wfile.write(data[start:start+server.drop_after])
+                    self.close_connection = True
+                    return
+                self.wfile.write(data[start:])
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1",0),Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+        self.files[f"{name}-nucl-metadata.json"] = json.dumps({
+            "version":"1.1",
+            "dbname":name,
+            "files":[self.url+fname for fname in volumes],
+            "bytes-total":sum(map(len,volumes.values())),
+        }).encode()
+        self.metadata_url = f"{self.url}{name}-nucl-metadata.json"
+        threading.Thread(target=self.httpd.serve_forever,daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@contextlib.contextmanager
+def fresh_cache(folder:str):
+    # Points blaster at an empty cache in folder
+    cache_folder, shared_cache = blaster.CACHE_FOLDER, blaster.shared_cache
+    blaster.CACHE_FOLDER = os.path.join(folder,"cache")
+    blaster.shared_cache = None
+    try:
+        yield
+    finally:
+        blaster.CACHE_FOLDER, blaster.shared_cache = cache_folder, shared_cache
+
+
+def fill_cache(sequences:list[str], db:str, remote:bool, hits:int, hsps:int):
+    # Writes a synthetic result of every sequence into the cache
+    cache = blaster.get_cache()
+    params = blaster.SearchParams(db=db,remote=remote)
+    for sequence in sequences:
+        md5_checksum = hashlib.md5(sequence.encode()).hexdigest()
+        cache.write(md5_checksum,params,synthetic_xml([(md5_checksum,len(sequence))],hits,hsps,seed=len(sequence)))
+
+
+def setup_stage(stage:str, folder:str, sequences:list[str], options:argparse.Namespace):
+    # Prepares the input of the stage in folder, and returns a function which runs the stage, and the bytes it processes
+    if stage == "parser":
+        path = os.path.join(folder,"input.fasta")
+        write_fasta(path,sequences)
+        return lambda: blaster.get_sequence(blaster.open_sequence_file(path)), os.path.getsize(path)
+    if stage == "parser-fastq":
+        path = os.path.join(folder,"input.fastq")
+        write_fastq(path,sequences)
+        return lambda: blaster.get_sequence(blaster.open_sequence_file(path)), os.path.getsize(path)
+    if stage == "parser-gzip":
+        path = os.path.join(folder,"input.fasta.gz")
+        write_fasta(path,sequences)
+        return lambda: blaster.get_sequence(blaster.open_sequence_file(path)), os.path.getsize(path)
+    if stage == "cache-lookup":
+        fill_cache(sequences,"nr",True,options.hits,options.hsps)
+        return lambda: (blaster.blast(sequence,"nr",cache_only=True) for sequence in sequences), None
+    if stage == "xml-parse":
+        xmls = [synthetic_xml([(f"sequence_{i}",len(sequence))],options.hits,options.hsps,seed=i) for i,sequence in enumerate(sequences)]
+        return lambda: (next(blaster.NCBIXML.parse(io.StringIO(xml))) for xml in xmls), sum(map(len,xmls))
+    if stage == "formatter":
+        records = [next(blaster.NCBIXML.parse(io.StringIO(synthetic_xml([(f"sequence_{i}",len(sequence))],options.hits,options.hsps,seed=i)))) for i,sequence in enumerate(sequences)]
+        return lambda: (list(blaster.record_formatter(record,options.hits,options.hsps)) for record in records), None
+    if stage == "summary-batch":
+        fill_cache(sequences,"nr",True,options.hits,options.hsps)
+        return lambda: blaster.summary_batch(sequences,db="nr",workers=options.workers), None
+    if stage == "local-batch":
+        os.environ["BENCHMARK_BLASTN_LATENCY"] = str(options.blastn_latency)
+        os.environ["BENCHMARK_HITS"], os.environ["BENCHMARK_HSPS"] = str(options.hits), str(options.hsps)
+        return lambda: blaster.blast_batch(sequences,db="bench",cache_only=False,workers=options.workers,remote=False,batch_size=options.batch_size), None
+    if stage == "remote-async":
+        return lambda: blaster.blast_batch(sequences,db="nr",cache_only=False,workers=options.workers,remote=True,batch_size=options.batch_size,engine="async"), None
+    if stage == "db-update":
+        volumes = {f"bench.{i:02d}.tar.gz":synthetic_volume(f"bench.{i:02d}",options.volume_size,seed=i) for i in range(options.volumes)}
+        def update():
+            # The db is installed into folder, a volume counts as an item once the update is done
+            server = MockVolumeServer("bench",volumes,options.drop_after or None)
+            cwd = os.getcwd()
+            os.chdir(folder)
+            try:
+                if not ncbi_updater.update_db(ncbi_updater.fetch_metadata(server.metadata_url),workers=options.workers):
+                    raise RuntimeError("Updating the db failed")
+            finally:
+                os.chdir(cwd)
+                server.close()
+            print(f"[.] {server.requests} requests, {server.ranges} resumed, {server.dropped} dropped",file=sys.stderr)
+            yield from volumes
+        return update, sum(map(len,volumes.values()))
+    raise ValueError(f"Unknown stage '{stage}', expected one of {', '.join(STAGES)}")
+
+
+def run_stage(stage:str, sequences:list[str], options:argparse.Namespace, trace_memory=False):
+    # Runs the stage in a new folder with an empty cache, and returns the seconds each item took, the bytes processed and the peak memory
+    with tempfile.TemporaryDirectory() as folder, fresh_cache(folder), open(os.devnull,"w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            run, size = setup_stage(stage,folder,sequences,options)
+            if trace_memory:
+                tracemalloc.start()
+            latencies = []
+            items = iter(run())
+            t = time.perf_counter()
+            while True:
+                try:
+                    next(items)
+                except StopIteration:
+                    break
+                latencies.append(time.perf_counter()-t)
+                t = time.perf_counter()
+            peak = None
+            if trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+    return latencies, size, peak
+
+
+def report(stage:str, latencies:list[float], size:int|None, peak:int|None):
+    seconds = float(np.sum(latencies))
+    percentiles = np.percentile(latencies,[50,90,99]) if len(latencies) != 0 else [float("nan")]*3
+    return {
+        "stage":stage,
+        "items":len(latencies),
+        "seconds":seconds,
+        "items_per_second":len(latencies)/seconds if seconds else float("inf"),
+        "mb_per_second":size/1024**2/seconds if size is not None and seconds else None,
+        "p50_ms":percentiles[0]*1000,
+        "p90_ms":percentiles[1]*1000,
+        "p99_ms":percentiles[2]*1000,
+        "max_ms":max(latencies,default=float("nan"))*1000,
+        "peak_mb":peak/1024**2 if peak is not None else None,
+    }
+
+
+def print_reports(reports:list[dict]):
+    print(f"{'stage':<14}{'items':>7}{'seconds':>9}{'items/s':>11}{'MB/s':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'peak MB':>9}")
+    for r in reports:
+        mb_per_second = f"{r['mb_per_second']:0.1f}" if r['mb_per_second'] is not None else "-"
+        peak = f"{r['peak_mb']:0.1f}" if r['peak_mb'] is not None else "-"
+        print(f"{r['stage']:<14}{r['items']:>7}{r['seconds']:>9.3f}{r['items_per_second']:>11.1f}{mb_per_second:>8}{r['p50_ms']:>9.3f}{r['p90_ms']:>9.3f}{r['p99_ms']:>9.3f}{r['max_ms']:>9.3f}{peak:>9}")
+
+
+def main(argv:list[str]|None=None):
+    arg_parser = argparse.ArgumentParser(description="Benchmarks the stages of blaster on synthetic data")
+    arg_parser.add_argument("--stages",default=",".join(STAGES),help=f"comma separated stages, of {', '.join(STAGES)}")
+    arg_parser.add_argument("--sequences",type=int,default=200,help="number of synthetic sequences")
+    arg_parser.add_argument("--length",type=int,default=500,help="mean length of the sequences")
+    arg_parser.add_argument("--hits",type=int,default=10,help="hits per synthetic result")
+    arg_parser.add_argument("--hsps",type=int,default=2,help="hsps per hit")
+    arg_parser.add_argument("--workers",type=int,default=4,help="workers of blast_batch and summary_batch")
+    arg_parser.add_argument("--batch-size",type=int,default=1,help="queries per blastn invocation or remote search")
+    arg_parser.add_argument("--blastn-latency",type=float,default=0.05,help="seconds each stub blastn invocation takes")
+    arg_parser.add_argument("--search-latency",type=float,default=0.5,help="seconds until a mock remote search is ready")
+    arg_parser.add_argument("--request-latency",type=float,default=0.01,help="seconds each mock remote request takes")
+    arg_parser.add_argument("--volumes",type=int,default=4,help="volumes of the db of db-update")
+    arg_parser.add_argument("--volume-size",type=int,default=4*1024**2,help="bytes of each volume")
+    arg_parser.add_argument("--drop-after",type=int,default=1024**2,help="bytes sent before the mock db server drops each connection, 0 never drops")
+    arg_parser.add_argument("--seed",type=int,default=0)
+    arg_parser.add_argument("--no-memory",action="store_true",help="skip the second run of each stage, which measures the peak memory")
+    arg_parser.add_argument("--json",help="also write the results to this file")
+    options = arg_parser.parse_args(argv)
+
+    rng = random.Random(options.seed)
+    sequences = [random_sequence(rng,max(20,int(rng.gauss(options.length,options.length/4)))) for _ in range(options.sequences)]
+    stages = [stage.strip() for stage in options.stages.split(",") if stage.strip()]
+
+    bin_folder = tempfile.mkdtemp()
+    install_stub_blastn(bin_folder)
+    server = MockBlastServer(options.search_latency,options.request_latency,options.hits,options.hsps)
+    remote_blast.BLAST_URL = server.url
+    remote_blast.SUBMIT_INTERVAL = 0
+    remote_blast.POLL_INTERVAL = max(0.01,options.search_latency/5)
+    remote_blast.POLL_RATE = 1000
+    # Dropped connections are resumed right away
+    ncbi_updater.DOWNLOAD_BACKOFF = 0
+
+    reports = []
+    try:
+        for stage in stages:
+            print(f"[.] Running {stage}",file=sys.stderr)
+            latencies, size, _ = run_stage(stage,sequences,options)
+            peak = None if options.no_memory else run_stage(stage,sequences,options,trace_memory=True)[2]
+            reports.append(report(stage,latencies,size,peak))
+    finally:
+        server.close()
+    print_reports(reports)
+    if options.json is not None:
+        with open(options.json,"w") as f:
+            json.dump(reports,f,indent=2)
+
+
+if __name__ == "__main__":
+    main()
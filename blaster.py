@@ -1,8 +1,15 @@
+from typing import Any,Callable,Iterable
 import concurrent.futures
+import collections
+import threading
 import hashlib
+import ctypes
+import gzip
+import bz2
 import time
 import os
 import io
+import re
 
 try:
     #from Bio import SeqIO
@@ -10,6 +17,7 @@ try:
     from Bio.Blast.Applications import NcbiblastnCommandline
     from Bio.Blast.Record import Blast,Alignment,HSP
     from Bio.Seq import Seq
+    import numpy as np
 except ImportError:
     print("[!] Could not import biopython")
     print("[.] To install it, run the following command 'pip install biopython'")
@@ -17,12 +25,28 @@ except ImportError:
     input("[?] Press enter to close")
     exit()
 
+from cache_store import CacheStore,SearchParams
+from job_manifest import JobManifest
+import remote_blast
+import db_versions
+from metrics import metrics
+
 CACHE_FOLDER = "cache"
+# Store results compressed in pack files, instead of one xml file per result
+CACHE_PACKED = False
+# Set CACHE_SHARED when the cache folder is shared by several nodes over NFS, results being searched for are locked either way
+CACHE_SHARED = False
+# Local blasts can use blastn's tabular output, with the columns summary_formatter needs, instead of xml
+TABULAR = 6
+TABULAR_OUTFMT = "6 qseqid saccver nident length qstart qend slen stitle"
+# Memory used by a blastn process besides the db, and the query length from where blastn threads pay off
+PROCESS_MEMORY = 256*1024**2
+THREADED_LENGTH = 5000
 ALLOWED_BASES = set("ATCGU")
 
 
 def main():
-    data_file = open("samlet.fasta")
+    data_file = open_sequence_file("samlet.fasta")
     dnas:list[Seq] = []
     for i,dna in enumerate(get_sequence(file=data_file)):
         print(i,dna[:10])
@@ -37,67 +61,811 @@ def main():
 
 
 def record_formatter(record:Blast,number_of_alignments:int=2,max_high_scoring_pairs:int=1):
-    # TODO This could use some cleaning
+    yield from summary_formatter(summarize_record(record,number_of_alignments),number_of_alignments,max_high_scoring_pairs)
+
+
+def summarize_record(record:Blast,number_of_alignments:int|None=None):
+    # Extracts what the formatter needs from the record, (query_length, [(acc, title, length, coverage, [(identities, align_length, query_start, query_end)])])
     if not isinstance(record,Blast):
         raise TypeError(f"hsp had unknown type, {type(record)}, expected Bio.Blast.Record")
-    alignments = list(record.alignments)
-    for alignment in alignments[:number_of_alignments]:
+    query_length = record.query_length if isinstance(record.query_length,int) else None
+    hits = []
+    for alignment in list(record.alignments)[:number_of_alignments]:
         # Make sure data is as it should be
         if not isinstance(alignment,Alignment):
             raise TypeError(f"alignment had unknown type, {type(alignment)}, expected Bio.Blast.Record.Alignment")
         acc = alignment.hit_id.split("|")[-2].strip()
         title = alignment.hit_def.strip()
-        hsps = list(alignment.hsps)
-
-        # Calculate query coverage
-        hsp_pairs = []
-        for hsp in hsps:
+        length = alignment.length if isinstance(alignment.length,int) else None
+        hsps = []
+        for hsp in alignment.hsps:
             if not isinstance(hsp,HSP):
                 raise TypeError(f"hsp had unknown type, {type(hsp)}, expected Bio.Blast.Record.HSP")
-            if isinstance(hsp.query_start,int) and isinstance(hsp.query_start,int) and isinstance(record.query_length,int):
-                hsp_pairs.append([hsp.query_start,hsp.query_end])
-        hsp_pairs.sort(key=lambda x:x[0])
-        stack = hsp_pairs[:1]
-        for i in hsp_pairs[1:]:
-            if stack[-1][0] <= i[0] <= stack[-1][-1]:
-                stack[-1][-1] = max(stack[-1][-1], i[-1])
-            else:
-                stack.append(i)
-        hsp_pairs = stack
-        qc = 0
-        for interval in hsp_pairs:
-            qc += interval[1]-interval[0]+1
-
-        # Extract
-        for hsp in hsps[:max_high_scoring_pairs]:
-            if not isinstance(hsp,HSP):
-                raise TypeError(f"hsp had unknown type, {type(hsp)}, expected Bio.Blast.Record.HSP")
-            if isinstance(hsp.identities,int) and isinstance(hsp.align_length,int):
-                match = f"{(hsp.identities/hsp.align_length)*100:0.2f}%".rjust(7," ")
-            else:
-                match = f"?%"
-            if isinstance(alignment.length,int):
-                bp = alignment.length
-            else:
-                bp = "?"
-            if qc != 0 and isinstance(record.query_length,int):
-                qc = f"{(qc/record.query_length)*100:0.2f}%".rjust(7," ")
-            else:
-                qc = "?"
-            yield acc, qc, match, bp, title
+            hsps.append((
+                hsp.identities if isinstance(hsp.identities,int) else None,
+                hsp.align_length if isinstance(hsp.align_length,int) else None,
+                hsp.query_start if isinstance(hsp.query_start,int) else None,
+                hsp.query_end if isinstance(hsp.query_end,int) else None,
+            ))
+        hits.append((acc, title, length, hsps))
+
+    # The coverage of all alignments are calculated in one go
+    coverages = query_coverages([hsps for _,_,_,hsps in hits]).tolist()
+    return query_length, [(acc, title, length, coverage, hsps) for (acc, title, length, hsps),coverage in zip(hits,coverages)]
+
+
+def query_coverages(hits:list[list[tuple]]):
+    # Counts the bases of the query covered by the union of the hsps of each hit
+    intervals = np.array([(i,query_start,query_end) for i,hsps in enumerate(hits) for _,_,query_start,query_end in hsps if query_start is not None and query_end is not None],dtype=np.int64).reshape(-1,3)
+    if len(intervals) == 0:
+        return np.zeros(len(hits),dtype=np.int64)
+    hit_index, starts, ends = intervals.T
+
+    # Offset each hit, so a single running maximum never crosses from one hit to the next
+    offset = hit_index*(max(ends.max(),starts.max())+2)
+    order = np.lexsort((starts,hit_index))
+    starts = (starts+offset)[order]
+    ends = (ends+offset)[order]
+    # Each interval adds the bases past the furthest end of the intervals before it
+    furthest_end = np.concatenate(([np.iinfo(np.int64).min],np.maximum.accumulate(ends)[:-1]))
+    added = np.maximum(0,ends-np.maximum(starts-1,furthest_end))
+    return np.bincount(hit_index[order],weights=added,minlength=len(hits)).astype(np.int64)
+
 
+def identity_percentages(hsps:list[tuple]):
+    # Percentage of identical bases of each hsp, nan if unknown
+    identities = np.array([np.nan if identities is None or align_length is None else identities for identities,align_length,_,_ in hsps],dtype=np.float64)
+    align_lengths = np.array([np.nan if identities is None or align_length is None else align_length for identities,align_length,_,_ in hsps],dtype=np.float64)
+    return identities/align_lengths*100
 
-def blast_batch(query_sequences:list[Seq], db="nr", cache_only=True, workers:int=1, remote=True):
+
+def summary_formatter(summary:tuple,number_of_alignments:int=2,max_high_scoring_pairs:int=1):
+    # Formats a summary from summarize_record into (acc, qc, match, bp, title)
+    for acc, coverage, identity, length, title in summary_values(summary,number_of_alignments,max_high_scoring_pairs):
+        qc = f"{coverage:0.2f}%".rjust(7," ") if coverage is not None else "?"
+        match = f"{identity:0.2f}%".rjust(7," ") if identity is not None else f"?%"
+        bp = length if length is not None else "?"
+        yield acc, qc, match, bp, title
+
+
+def summary_values(summary:tuple,number_of_alignments:int=2,max_high_scoring_pairs:int=1):
+    # Yields (acc, query coverage %, identity %, bp, title) of a summary from summarize_record as numbers, None where unknown
+    query_length, hits = summary
+    hits = hits[:number_of_alignments]
+    hsps = [hsp for _,_,_,_,hit_hsps in hits for hsp in hit_hsps[:max_high_scoring_pairs]]
+    if len(hsps) == 0:
+        return
+    # Calculate the numbers of all hsps at once
+    matches = identity_percentages(hsps).tolist()
+    coverages = (np.array([coverage for _,_,_,coverage,_ in hits],dtype=np.float64)/(query_length or 1)*100).tolist()
+    i = 0
+    for (acc, title, length, coverage, hit_hsps),coverage_percentage in zip(hits,coverages):
+        coverage_percentage = coverage_percentage if coverage != 0 and query_length is not None else None
+        for match_percentage in matches[i:i+len(hit_hsps[:max_high_scoring_pairs])]:
+            yield acc, coverage_percentage, match_percentage if match_percentage == match_percentage else None, length, title
+        i += len(hit_hsps[:max_high_scoring_pairs])
+
+
+def summary_batch(query_sequences:Iterable[Seq], db="nr", remote=True, workers:int=1, ordered=True, tabular=False, cancel:threading.Event|None=None):
+    # Yields the summary of each cached result, the xml is only parsed the first time, sequences without a result have no hits
+    # Parsing is spread over a pool of processes, and only the summaries are sent back
+    # Once cancel is set no more sequences are read, and the summaries already being parsed are still yielded
+    query_sequences = until_cancelled(query_sequences,cancel)
+    cache = get_cache()
+    params = search_params(db,remote,tabular)
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    def submit(query_sequence:Seq):
+        query_sequence = str(query_sequence)
+        md5_checksum = hashlib.md5(query_sequence.encode()).hexdigest()
+        with metrics.timer("summary_read",md5_checksum):
+            summary = cache.read_summary(md5_checksum,params)
+        if summary is not None:
+            return completed_future(lambda: (query_sequence, summary, 0.0, False))
+        if tabular:
+            # Tabular results are cheap to parse, and are summarized as they are saved
+            return completed_future(lambda: (query_sequence, read_tabular_summary(md5_checksum,params,len(query_sequence)) or (len(query_sequence),[]), 0.0, False))
+        result = cache.read(md5_checksum,params)
+        if result is None:
+            # Not blasted yet, e.g. after a cancelled run, so it is yielded without hits
+            print(f"[!] Cache of '{md5_checksum}' is empty")
+            return completed_future(lambda: (query_sequence, (len(query_sequence),[]), 0.0, False))
+        xml = result.read()
+        if executor is None:
+            return completed_future(lambda: (query_sequence, *timed(summarize_xml,xml), True))
+        return chain_future(executor.submit(timed,summarize_xml,xml),lambda result: (query_sequence, *result, True))
+    try:
+        results = submit_ordered if ordered else submit_bounded
+        for query_sequence, summary, seconds, new in results(submit,query_sequences,workers*4):
+            if new:
+                md5_checksum = hashlib.md5(query_sequence.encode()).hexdigest()
+                metrics.record("xml_parse",md5_checksum,seconds)
+                cache.write_summary(md5_checksum,params,summary)
+            yield query_sequence, summary
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        metrics.write()
+
+
+def summarize_xml(xml:str):
+    # Runs in the process pool of summary_batch
+    return summarize_record(next(NCBIXML.parse(io.StringIO(xml))))
+
+
+def timed(func:Callable, *args):
+    # Returns the result of func and the seconds it took, so work done in a process pool can be timed where it runs
+    t = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter()-t
+
+
+def queued(func:Callable, md5_checksums:list[str]):
+    # Wraps func to record how long the sequences waited for a worker before func started
+    submitted = time.perf_counter()
+    def run(*args):
+        waited = time.perf_counter()-submitted
+        for md5_checksum in md5_checksums:
+            metrics.record("queue_wait",md5_checksum,waited)
+        return func(*args)
+    return run
+
+
+def blast_batch(query_sequences:Iterable[Seq], db="nr", cache_only=True, workers:int|None=1, remote=True, batch_size:int=1, batch_length:int|None=None, engine="threads", order="input", threads:int=1, tabular=False, manifest:str|None=None, cancel:threading.Event|None=None, skip_done=True):
+    # engine="async" runs remote searches from one event loop, starting with workers outstanding searches and adapting from there
+    # order="longest" reads all sequences first, and starts the ones estimated to take the longest first
+    # threads is the number of threads of each local blastn, workers=None picks both for local runs from the cpus, memory and sequences
+    # tabular=True saves the compact tabular output of local blastn instead of xml, and yields summaries instead of blast records
+    # manifest is the path of a JobManifest, sequences done by an earlier run with the same manifest are skipped and not yielded, unless skip_done=False
+    # Once cancel is set no more sequences are started, the blasts already running are finished and yielded, and the rest stay queued in the manifest
+    params = search_params(db,remote,tabular)
     remove_empty_cache()
     print("[.] Running blast!")
+    t = time.perf_counter()
+    completed = 0
+    def counted(results:Iterable):
+        nonlocal completed
+        for result in results:
+            completed += 1
+            metrics.count("sequences_total",engine=engine if remote else "local")
+            yield result
+    job_manifest = JobManifest(manifest,params) if manifest is not None else None
+    if job_manifest is not None:
+        query_sequences = job_manifest.pending(query_sequences,skip_done)
+    def track(future:concurrent.futures.Future, md5_checksums:list[str]):
+        # Records in the manifest whether the sequences made it into the cache
+        if job_manifest is not None:
+            def callback(done:concurrent.futures.Future):
+                for md5_checksum in md5_checksums:
+                    if done.exception() is not None:
+                        job_manifest.finish(md5_checksum,error=repr(done.exception()))
+                    elif get_cache().exists(md5_checksum,params):
+                        job_manifest.finish(md5_checksum)
+                    else:
+                        job_manifest.finish(md5_checksum,error="Not in cache")
+            future.add_done_callback(callback)
+        return future
+    if order == "longest" and not cache_only:
+        query_sequences = order_by_cost(query_sequences,db,remote,tabular)
+    if workers is None:
+        if remote or cache_only:
+            workers = 1
+        else:
+            query_sequences = list(query_sequences)
+            workers, threads = plan_local_run([len(query_sequence) for query_sequence in query_sequences],db,batch_size)
+    query_sequences = until_cancelled(query_sequences,cancel)
     with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        futures = {executor.submit(lambda query_sequence: blast(query_sequence,db,cache_only,remote),query_sequence): query_sequence for query_sequence in query_sequences}
-        for future in concurrent.futures.as_completed(futures):
-            yield future.result()
+        if engine == "async" and remote and not cache_only:
+            yield from counted(blast_async(make_batches(query_sequences,batch_size,batch_length),db,workers,job_manifest))
+        elif batch_size > 1 and not cache_only:
+            # Pack several queries into each blastn invocation or qblast submission
+            batches = make_batches(query_sequences,batch_size,batch_length)
+            def submit(batch:list[Seq]):
+                md5_checksums = [hashlib.md5(str(query_sequence).encode()).hexdigest() for query_sequence in batch]
+                return track(executor.submit(queued(blast_multi,md5_checksums),batch,db,remote,threads,tabular),md5_checksums)
+            for results in submit_bounded(submit,batches,workers*2):
+                yield from counted(results)
+        else:
+            submitted:dict[str,concurrent.futures.Future] = dict()
+            def submit(query_sequence:Seq):
+                md5_checksum = hashlib.md5(str(query_sequence).encode()).hexdigest()
+                future = submitted.get(md5_checksum)
+                if future is not None:
+                    # Duplicates wait for the first blast of the sequence without taking up a worker
+                    return chain_future(future,lambda _: blast(query_sequence,db,True,remote,tabular=tabular))
+                future = track(executor.submit(queued(blast,[md5_checksum]),query_sequence,db,cache_only,remote,threads,tabular),[md5_checksum])
+                submitted[md5_checksum] = future
+                future.add_done_callback(lambda _: submitted.pop(md5_checksum,None))
+                return future
+            yield from counted(submit_bounded(submit,query_sequences,workers*2))
+    seconds = time.perf_counter()-t
+    metrics.record("batch","batch",seconds,sequences=completed,sequences_per_minute=completed/seconds*60 if seconds else 0.0)
+    metrics.write()
+    if job_manifest is not None:
+        print(f"[.] Manifest '{manifest}' has {', '.join(f'{count} {state}' for state,count in job_manifest.counts().items())}")
     print("[.] Blast done!")
 
 
-def blast(query_sequence:Seq|str,db="nr",cache_only=False, remote=True):
+def blast_summaries(query_sequences:Iterable[Seq], db="nr", remote=True, ordered=False, **options):
+    # Blasts the sequences and yields (position, query_sequence, summary) of each as soon as its blast is done, in a single pass
+    # position is the index of the sequence in query_sequences, ordered=True holds results back until the ones before them are yielded
+    # options are passed on to blast_batch, with a manifest the sequences done by an earlier run are yielded from the cache
+    cache = get_cache()
+    tabular = options.get("tabular",False)
+    params = search_params(db,remote,tabular)
+    lock = threading.Lock()
+    positions:dict[str,collections.deque[int]] = dict()
+    def numbered():
+        # The async engine reads the sequences from its own thread
+        for position,query_sequence in enumerate(query_sequences):
+            with lock:
+                positions.setdefault(hashlib.md5(str(query_sequence).encode()).hexdigest(),collections.deque()).append(position)
+            yield query_sequence
+    def summaries():
+        for query_sequence, records in blast_batch(numbered(),db=db,remote=remote,skip_done=False,**options):
+            query_sequence = str(query_sequence)
+            md5_checksum = hashlib.md5(query_sequence.encode()).hexdigest()
+            with lock:
+                # Identical sequences share a result, so any of their positions will do
+                position = positions[md5_checksum].popleft()
+                if len(positions[md5_checksum]) == 0:
+                    del positions[md5_checksum]
+            summary = next(records,None) if tabular else cache.read_summary(md5_checksum,params)
+            if summary is None and not tabular:
+                try:
+                    with metrics.timer("xml_parse",md5_checksum):
+                        summary = summarize_record(next(records))
+                    cache.write_summary(md5_checksum,params,summary)
+                except ValueError:
+                    # The cache is empty, which blast already reported
+                    pass
+            yield position, query_sequence, summary or (len(query_sequence),[])
+    yield from reorder(summaries()) if ordered else summaries()
+
+
+def reorder(results:Iterable[tuple]):
+    # Yields results, which start with their position, in order of position
+    held:dict[int,tuple] = dict()
+    position = 0
+    for result in results:
+        held[result[0]] = result
+        while position in held:
+            yield held.pop(position)
+            position += 1
+    # Positions which never came, e.g. after a cancel, are skipped
+    for position in sorted(held):
+        yield held[position]
+
+
+def until_cancelled(items:Iterable, cancel:threading.Event|None):
+    # Stops taking items once cancel is set, so whatever was already started can finish
+    for item in items:
+        if cancel is not None and cancel.is_set():
+            print("[!] Cancelled, finishing what was already started")
+            return
+        yield item
+
+
+def submit_bounded(submit:Callable[[Any],concurrent.futures.Future], items:Iterable, max_pending:int):
+    # Submits items lazily, so at most max_pending futures are waiting at a time
+    pending:set[concurrent.futures.Future] = set()
+    for item in items:
+        pending.add(submit(item))
+        if len(pending) >= max_pending:
+            done, pending = concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+
+def submit_ordered(submit:Callable[[Any],concurrent.futures.Future], items:Iterable, max_pending:int):
+    # Like submit_bounded, but yields the results in the order of the items
+    pending:collections.deque[concurrent.futures.Future] = collections.deque()
+    for item in items:
+        pending.append(submit(item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def chain_future(future:concurrent.futures.Future, func:Callable):
+    # Returns a future for the result of func, which is called with the result of future once it is done
+    chained = concurrent.futures.Future()
+    def callback(done:concurrent.futures.Future):
+        if done.exception() is not None:
+            chained.set_exception(done.exception())
+            return
+        try:
+            chained.set_result(func(done.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+    future.add_done_callback(callback)
+    return chained
+
+
+def completed_future(func:Callable):
+    # Returns a future which is already done with the result of func
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(func())
+    except BaseException as e:
+        future.set_exception(e)
+    return future
+
+
+def blast_async(batches:Iterable[list[Seq]], db="nr", max_outstanding:int=10, job_manifest:JobManifest|None=None):
+    # Yields the results of the sequences, each batch of sequences not in the cache is one remote_blast search
+    # With a job_manifest, the searches an earlier run submitted are resumed by their RID, and the RIDs of new searches are recorded
+    cache = get_cache()
+    params = SearchParams(db=db,remote=True)
+    lock = threading.Lock()
+    waiting:dict[str,list[str]] = dict()
+    searches:dict[str,tuple[list[str],int|None,float]] = dict()
+    # Sequences found in the cache, in the order their keys are passed through remote_blast.stream
+    cached:collections.deque[tuple[str,str]] = collections.deque()
+    # The sequences this process searches for are locked, the ones another process is searching for are waited for once these are done
+    locked:set[str] = set()
+    busy:list[str] = []
+    def lock_result(md5_checksum:str):
+        if not cache.lock_result(md5_checksum,params,blocking=False):
+            return False
+        with lock:
+            locked.add(md5_checksum)
+        return True
+    def unlock_result(md5_checksum:str):
+        with lock:
+            locked.discard(md5_checksum)
+        cache.unlock_result(md5_checksum,params)
+    def search(pending:dict[str,str]):
+        # Marks the sequences, which this process holds the locks of, as being searched for, and returns the query of one search for them
+        for md5_checksum in pending:
+            cache.start(md5_checksum,params)
+        # The query names are the MD5 sums, so the output can be split back into cache files
+        search_checksum = hashlib.md5("".join(pending).encode()).hexdigest()
+        fasta = "".join(f">{md5_checksum}\n{query_sequence}\n" for md5_checksum,query_sequence in pending.items())
+        with lock:
+            searches[search_checksum] = (list(pending),sum(map(len,pending.values())),time.time())
+        if job_manifest is not None:
+            job_manifest.add_search(search_checksum,fasta)
+        return search_checksum, fasta, None
+    def queries():
+        # Runs in the event loop thread of remote_blast.stream
+        # A sequence is only searched for once it is locked and still not in the cache, as another process may have finished it since
+        for search_checksum, fasta, rid in job_manifest.outstanding() if job_manifest is not None else []:
+            records = re.findall(r">(\S+)\n([^>]*)",fasta)
+            pending:dict[str,str] = dict()
+            for md5_checksum, query_sequence in records:
+                # Sequences left out here are read again from the input, and found in the cache or waited for there
+                if not lock_result(md5_checksum):
+                    continue
+                if cache.exists(md5_checksum,params):
+                    unlock_result(md5_checksum)
+                    continue
+                pending[md5_checksum] = query_sequence.replace("\n","")
+            if len(pending) == 0:
+                continue
+            with lock:
+                for md5_checksum in pending:
+                    waiting.setdefault(md5_checksum,[])
+            if len(pending) != len(records):
+                # Part of the search was taken over by other processes, so the rest is searched for again on its own
+                yield search(pending)
+                continue
+            with lock:
+                # The runtime of a resumed search is unknown
+                searches[search_checksum] = (list(pending),None,time.time())
+            for md5_checksum in pending:
+                cache.start(md5_checksum,params)
+            yield search_checksum, fasta, rid
+        for batch in batches:
+            pending = dict()
+            for query_sequence in map(str,batch):
+                md5_checksum = hashlib.md5(query_sequence.encode()).hexdigest()
+                with lock:
+                    if md5_checksum in waiting:
+                        waiting[md5_checksum].append(query_sequence)
+                        continue
+                    if not cache.exists(md5_checksum,params):
+                        waiting[md5_checksum] = [query_sequence]
+                        pending[md5_checksum] = query_sequence
+                        continue
+                    cached.append((md5_checksum,query_sequence))
+                # Passed through without a query, so it is yielded as soon as the consumer gets to it
+                yield md5_checksum, None, None
+            for md5_checksum in list(pending):
+                if not lock_result(md5_checksum):
+                    del pending[md5_checksum]
+                    with lock:
+                        busy.extend(waiting.pop(md5_checksum))
+                elif cache.exists(md5_checksum,params):
+                    # Finished by another process since it was looked up
+                    unlock_result(md5_checksum)
+                    del pending[md5_checksum]
+                    with lock:
+                        query_sequences_done = waiting.pop(md5_checksum)
+                        cached.extend((md5_checksum,query_sequence) for query_sequence in query_sequences_done)
+                    for _ in query_sequences_done:
+                        yield md5_checksum, None, None
+            if len(pending) != 0:
+                yield search(pending)
+
+    on_submit = job_manifest.submitted if job_manifest is not None else None
+    try:
+        for search_checksum, xml, error in remote_blast.stream(queries(),params,max_outstanding=max_outstanding,on_submit=on_submit):
+            if xml is None and error is None:
+                with lock:
+                    md5_checksum, query_sequence = cached.popleft()
+                if job_manifest is not None:
+                    job_manifest.finish(md5_checksum)
+                yield blast(query_sequence,db,cache_only=True,remote=True)
+                continue
+            with lock:
+                md5_checksums, length, t = searches.pop(search_checksum)
+            if error is not None:
+                # The sequences of a failed search are unlocked for other processes, and yielded without results
+                for md5_checksum in md5_checksums:
+                    unlock_result(md5_checksum)
+                    if job_manifest is not None:
+                        job_manifest.finish(md5_checksum,error=repr(error))
+                    with lock:
+                        query_sequences_failed = waiting.pop(md5_checksum)
+                    for query_sequence in query_sequences_failed:
+                        yield blast(query_sequence,db,cache_only=True,remote=True)
+                continue
+            print(f"[.] {search_checksum} Saving to cache")
+            if length is not None:
+                cache.record_runtime(params,length,time.time()-t)
+            for md5_checksum, split_xml in split_blast_xml(xml,md5_checksums).items():
+                metrics.record("remote",md5_checksum,time.time()-t,search=search_checksum,queries=len(md5_checksums),resumed=length is None)
+                cache.write(md5_checksum,params,split_xml)
+                unlock_result(md5_checksum)
+                if job_manifest is not None:
+                    job_manifest.finish(md5_checksum)
+                with lock:
+                    query_sequences_done = waiting.pop(md5_checksum)
+                for query_sequence in query_sequences_done:
+                    yield blast(query_sequence,db,cache_only=True,remote=True)
+    finally:
+        # Searches which failed or were abandoned are unlocked, so other processes can take them over
+        for md5_checksum in list(locked):
+            unlock_result(md5_checksum)
+    # blast waits for the other process, and only searches for the sequence itself if that process didn't finish it
+    for query_sequence in busy:
+        result = blast(query_sequence,db,remote=True)
+        if job_manifest is not None:
+            job_manifest.finish(hashlib.md5(query_sequence.encode()).hexdigest())
+        yield result
+
+
+def plan_local_run(lengths:list[int], db:str, batch_size:int=1):
+    # Splits the cpus between blastn processes and threads per process
+    # Many short queries run best as one single threaded process per cpu, while few or long queries need threads to use all cpus
+    # Every process maps the db on its own, so the available memory limits the number of processes
+    cpus = os.cpu_count() or 1
+    jobs = max(1,-(-len(lengths)//max(1,batch_size)))
+    memory = available_memory()
+    process_memory = PROCESS_MEMORY+largest_volume_size(db)
+    max_processes = max(1,min(cpus,memory//process_memory)) if memory is not None else cpus
+    median_length = float(np.median(lengths)) if len(lengths) != 0 else 0
+    if jobs >= cpus and median_length < THREADED_LENGTH:
+        processes = max_processes
+    else:
+        processes = max(1,min(jobs,max_processes))
+    # When memory limits the processes, the cpus they leave idle are given to them as threads
+    threads = max(1,cpus//processes)
+    memory_text = f"{memory/1024**3:0.1f} GB" if memory is not None else "unknown"
+    print(f"[.] Running {processes} blastn processes with {threads} threads each, for {jobs} jobs with a median length of {median_length:0.0f} BP on {cpus} cpus with {memory_text} of memory available")
+    return processes, threads
+
+
+def available_memory():
+    # Returns the available memory in bytes, or None if it is unknown
+    if os.name == 'nt':
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength",ctypes.c_ulong),("dwMemoryLoad",ctypes.c_ulong),("ullTotalPhys",ctypes.c_ulonglong),("ullAvailPhys",ctypes.c_ulonglong),("ullTotalPageFile",ctypes.c_ulonglong),("ullAvailPageFile",ctypes.c_ulonglong),("ullTotalVirtual",ctypes.c_ulonglong),("ullAvailVirtual",ctypes.c_ulonglong),("sullAvailExtendedVirtual",ctypes.c_ulonglong)]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+        return status.ullAvailPhys
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+    except (ValueError,OSError,AttributeError):
+        return None
+
+
+def largest_volume_size(db:str):
+    # blastn scans the volumes of a db one at a time, so the largest volume is what a process needs in memory
+    volumes:dict[str,int] = dict()
+    if os.path.isdir(db):
+        for filename in os.listdir(db):
+            volume = filename.rsplit(".",1)[0]
+            volumes[volume] = volumes.get(volume,0)+os.path.getsize(os.path.join(db,filename))
+    return max(volumes.values(),default=0)
+
+
+def order_by_cost(query_sequences:Iterable[Seq], db="nr", remote=True, tabular=False):
+    # Longest processing time first, so no long search is started while the other workers run out of work
+    query_sequences = list(query_sequences)
+    costs = estimate_costs([len(query_sequence) for query_sequence in query_sequences],search_params(db,remote,tabular))
+    order = np.argsort(-costs,kind="stable")
+    print(f"[.] Estimated {costs.sum():0.0f} seconds of blasting, longest first")
+    return [query_sequences[i] for i in order]
+
+
+def estimate_costs(lengths:list[int], params:SearchParams):
+    # Estimates the seconds each search takes, from a linear fit of seconds to length of the past searches
+    lengths = np.array(lengths,dtype=np.float64)
+    runtimes = np.array(get_cache().runtimes(params),dtype=np.float64).reshape(-1,2)
+    if len(runtimes) == 0:
+        return lengths
+    if len(np.unique(runtimes[:,0])) < 2:
+        slope, intercept = runtimes[:,1].sum()/max(1,runtimes[:,0].sum()), 0.0
+    else:
+        slope, intercept = np.polyfit(runtimes[:,0],runtimes[:,1],1)
+    return np.maximum(0,intercept)+np.maximum(0,slope)*lengths
+
+
+def make_batches(query_sequences:Iterable[Seq], batch_size:int, batch_length:int|None=None):
+    # Groups the sequences into batches of at most batch_size sequences and at most batch_length bases
+    # A sequence longer than batch_length gets a batch of its own
+    batch:list[Seq] = []
+    length = 0
+    for query_sequence in query_sequences:
+        if len(batch) >= batch_size or (batch_length is not None and len(batch) != 0 and length+len(query_sequence) > batch_length):
+            yield batch
+            batch = []
+            length = 0
+        batch.append(query_sequence)
+        length += len(query_sequence)
+    if len(batch) != 0:
+        yield batch
+
+
+def blast_multi(query_sequences:list[Seq|str], db="nr", remote=True, threads:int=1, tabular=False):
+    # Arg check
+    for query_sequence in query_sequences:
+        if not isinstance(query_sequence,(Seq,str)):
+            raise TypeError(f"Got query_sequence of type {type(query_sequence)}, expected Seq or str")
+    query_sequences = [str(query_sequence) for query_sequence in query_sequences]
+
+    cache = get_cache()
+    params = search_params(db,remote,tabular)
+
+    # Only blast the sequences which are not cached yet, and only once each
+    pending:dict[str,str] = dict()
+    flights:dict[str,concurrent.futures.Future] = dict()
+    waiting:list[concurrent.futures.Future] = []
+    for query_sequence in query_sequences:
+        md5_checksum = hashlib.md5(query_sequence.encode()).hexdigest()
+        if md5_checksum in pending:
+            continue
+        # Sequences which are being blasted by another thread are waited for instead
+        key = cache.key(md5_checksum,params)
+        future, owner = in_flight_blasts.claim(key)
+        if not owner:
+            waiting.append(future)
+        elif cache.exists(md5_checksum,params):
+            in_flight_blasts.release(key,future)
+        else:
+            pending[md5_checksum] = query_sequence
+            flights[key] = future
+
+    try:
+        run_blast_multi(pending,params,threads)
+    except BaseException as e:
+        for key,future in flights.items():
+            in_flight_blasts.release(key,future,exception=e)
+        raise
+    for key,future in flights.items():
+        in_flight_blasts.release(key,future)
+    for future in waiting:
+        future.result()
+
+    return [blast(query_sequence,db,cache_only=True,remote=remote,tabular=tabular) for query_sequence in query_sequences]
+
+
+def run_blast_multi(pending:dict[str,str], params:SearchParams, threads:int=1):
+    # Blasts the pending sequences, keyed by their MD5 sums, in one go and saves them to cache
+    # Sequences another process is blasting are waited for afterwards, one at a time without holding any other lock,
+    # and only blasted here if that process didn't finish them
+    cache = get_cache()
+    locked:dict[str,str] = dict()
+    busy:dict[str,str] = dict()
+    try:
+        for md5_checksum,query_sequence in pending.items():
+            if not cache.lock_result(md5_checksum,params,blocking=False):
+                busy[md5_checksum] = query_sequence
+            elif cache.exists(md5_checksum,params):
+                # Finished by another process since it was looked up
+                cache.unlock_result(md5_checksum,params)
+            else:
+                locked[md5_checksum] = query_sequence
+        blast_locked(locked,params,threads)
+    finally:
+        for md5_checksum in locked:
+            cache.unlock_result(md5_checksum,params)
+    if len(busy) != 0:
+        print(f"[.] Waiting for {len(busy)} sequences which another process is blasting")
+    for md5_checksum,query_sequence in busy.items():
+        cache.lock_result(md5_checksum,params)
+        try:
+            if not cache.exists(md5_checksum,params):
+                blast_locked({md5_checksum:query_sequence},params,threads)
+        finally:
+            cache.unlock_result(md5_checksum,params)
+
+
+def blast_locked(pending:dict[str,str], params:SearchParams, threads:int=1):
+    # Blasts the pending sequences, which this process holds the locks of, in one go and saves them to cache
+    cache = get_cache()
+    db = params.db
+    if len(pending) != 0:
+        for md5_checksum in pending:
+            cache.start(md5_checksum,params)
+        # The query names are the MD5 sums, so the output can be split back into cache files
+        batch_checksum = hashlib.md5("".join(pending).encode()).hexdigest()
+        fasta = "".join(f">{md5_checksum}\n{query_sequence}\n" for md5_checksum,query_sequence in pending.items())
+        print(f"[.] {batch_checksum} Running blast with {len(pending)} queries and {sum(map(len,pending.values()))} BP")
+        t = time.time()
+        if params.remote:
+            # Submit all the queries at once
+            result_handle:io.StringIO = remote_blast.with_backoff(lambda: NCBIWWW.qblast(program=params.program,database=db,sequence=fasta,megablast=params.megablast))
+            if not isinstance(result_handle,io.StringIO):
+                raise TypeError(f"result_handle returned type {type(result_handle)} expected io.StringIO")
+            result = result_handle.getvalue()
+        else:
+            # Run blast locally, the queries are piped to blastn and the results read from its output
+            # The db is used through its current version, which isn't removed by an update until blastn is done with it
+            outfmt = f'"{TABULAR_OUTFMT}"' if params.outfmt == TABULAR else params.outfmt
+            with db_versions.use(db) as db_folder:
+                result, _ = NcbiblastnCommandline(cmd=params.program,db=db_folder+"/"+db,outfmt=outfmt,task='megablast' if params.megablast else params.program,num_threads=threads)(stdin=fasta)
+
+        for md5_checksum in pending:
+            metrics.record("qblast" if params.remote else "blastn",md5_checksum,time.time()-t,batch=batch_checksum,queries=len(pending))
+        print(f"[.] {batch_checksum} Saving to cache")
+        if params.outfmt == TABULAR:
+            for md5_checksum,rows in split_tabular(result,list(pending)).items():
+                cache.write(md5_checksum,params,rows)
+                cache.write_summary(md5_checksum,params,parse_tabular(rows,len(pending[md5_checksum])))
+        else:
+            for md5_checksum,xml in split_blast_xml(result,list(pending)).items():
+                cache.write(md5_checksum,params,xml)
+        cache.record_runtime(params,sum(map(len,pending.values())),time.time()-t)
+        print(f"[.] {batch_checksum} Blast took {int(time.time()-t)} seconds")
+
+
+def split_blast_xml(xml:str, query_names:list[str]):
+    # Splits a multi query blast xml into single query blast xml, keyed by the query names
+    iterations:list[tuple[str,str,str]] = []
+    # Older blast versions concatenate an entire xml document per query
+    for document in re.split(r"(?=<\?xml )",xml):
+        start = document.find("<BlastOutput_iterations>")
+        end = document.rfind("</BlastOutput_iterations>")
+        if start == -1 or end == -1:
+            continue
+        head = document[:start+len("<BlastOutput_iterations>")]
+        tail = document[end:]
+        for match in re.finditer(r"<Iteration>.*?</Iteration>",document[start:end],re.S):
+            iteration = match.group()
+            labels = re.findall(r"<Iteration_query-(?:ID|def)>(.*?)</Iteration_query-(?:ID|def)>",iteration,re.S)
+            iterations.append((" ".join(labels), head+"\n"+iteration+"\n", tail))
+
+    if len(iterations) != len(query_names):
+        raise ValueError(f"Got {len(iterations)} iterations in blast xml, expected {len(query_names)}")
+
+    # Match on the query name, fall back to the query order
+    split:dict[str,str] = dict()
+    for i,(labels,head,tail) in enumerate(iterations):
+        query_name = next((query_name for query_name in query_names if query_name in labels), query_names[i])
+        split[query_name] = head+tail
+    return split
+
+
+class SingleFlight:
+    # Shares one in-progress call between all callers using the same key
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls:dict[str,concurrent.futures.Future] = dict()
+
+    def claim(self, key:str):
+        # Returns the future of the call for key, and whether the caller owns the call
+        with self.lock:
+            if key in self.calls:
+                return self.calls[key], False
+            future = concurrent.futures.Future()
+            self.calls[key] = future
+            return future, True
+
+    def release(self, key:str, future:concurrent.futures.Future, result:Any=None, exception:BaseException|None=None):
+        # Ends an owned call, later callers with the same key will make a new call
+        with self.lock:
+            del self.calls[key]
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+
+    def do(self, key:str, func:Callable):
+        future, owner = self.claim(key)
+        if not owner:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            self.release(key,future,exception=e)
+            raise
+        self.release(key,future,result)
+        return result
+
+
+in_flight_blasts = SingleFlight()
+
+
+def get_cache():
+    # The cache is opened on first use
+    global shared_cache
+    with shared_cache_lock:
+        if shared_cache is None:
+            shared_cache = CacheStore(CACHE_FOLDER,packed=CACHE_PACKED,shared=CACHE_SHARED)
+    return shared_cache
+
+shared_cache:CacheStore|None = None
+shared_cache_lock = threading.Lock()
+
+
+def split_tabular(rows:str, query_names:list[str]):
+    # Splits tabular blast output into the rows of each query, queries without hits get no rows
+    split:dict[str,list[str]] = {query_name:[] for query_name in query_names}
+    for row in rows.splitlines(keepends=True):
+        query_name = row.split("\t",1)[0]
+        if query_name in split:
+            split[query_name].append(row)
+    return {query_name:"".join(query_rows) for query_name,query_rows in split.items()}
+
+
+def parse_tabular(rows:str, query_length:int):
+    # Parses the rows of one query in the TABULAR_OUTFMT format into a summary like summarize_record
+    hits:dict[str,tuple[str,str,int|None,list[tuple]]] = dict()
+    for row in rows.splitlines():
+        if not row or row.startswith("#"):
+            continue
+        _, acc, identities, align_length, query_start, query_end, length, title = row.split("\t",7)
+        if acc not in hits:
+            hits[acc] = (acc, title.strip(), int(length), [])
+        hits[acc][3].append((int(identities),int(align_length),int(query_start),int(query_end)))
+    coverages = query_coverages([hsps for _,_,_,hsps in hits.values()]).tolist()
+    return query_length, [(acc, title, length, coverage, hsps) for (acc, title, length, hsps),coverage in zip(hits.values(),coverages)]
+
+
+def read_tabular_summary(md5_checksum:str, params:SearchParams, query_length:int):
+    # Returns the summary of a cached tabular result, or None if it isn't in the cache
+    cache = get_cache()
+    summary = cache.read_summary(md5_checksum,params)
+    if summary is None:
+        result = cache.read(md5_checksum,params)
+        if result is None:
+            return None
+        summary = parse_tabular(result.read(),query_length)
+        cache.write_summary(md5_checksum,params,summary)
+    return summary
+
+
+def search_params(db:str, remote:bool, tabular=False):
+    # blastn only writes tabular output locally, qblast always returns xml
+    if tabular and remote:
+        raise ValueError("Tabular output is only supported for local blast")
+    return SearchParams(db=db,remote=remote,outfmt=TABULAR if tabular else 5)
+
+
+def blast(query_sequence:Seq|str,db="nr",cache_only=False, remote=True, threads:int=1, tabular=False):
     # Arg check
     if not isinstance(query_sequence,(Seq,str)):
         raise TypeError(f"Got query_sequence of type {type(query_sequence)}, expected Seq or str")
@@ -105,102 +873,143 @@ def blast(query_sequence:Seq|str,db="nr",cache_only=False, remote=True):
 
     # Calculate MD5_sum for cache
     md5_checksum = hashlib.md5(query_sequence.encode()).hexdigest()
-    file_name = os.path.join(CACHE_FOLDER,f"{md5_checksum}.xml")
+    params = search_params(db,remote,tabular)
+
+    # Identical queries running at the same time share a single blast
+    in_flight_blasts.do(get_cache().key(md5_checksum,params),lambda: cache_blast(query_sequence,md5_checksum,params,cache_only,threads))
 
+    if tabular:
+        # Tabular results have no blast records, so the summary is returned in their place
+        summary = read_tabular_summary(md5_checksum,params,len(query_sequence))
+        if summary is None:
+            print(f"[!] Cache of '{md5_checksum}' is empty")
+        return (query_sequence, iter([summary] if summary is not None else []))
+
+    with metrics.timer("cache_read",md5_checksum):
+        result = get_cache().read(md5_checksum,params)
+    if result is None:
+        print(f"[!] Cache of '{md5_checksum}' is empty")
+        result = io.StringIO("")
+    blast_records = NCBIXML.parse(result)
+    return (query_sequence, blast_records)
+
+
+def cache_blast(query_sequence:str, md5_checksum:str, params:SearchParams, cache_only=False, threads:int=1):
+    cache = get_cache()
+    db = params.db
     # Cache exists great, if not run blast
-    if os.path.exists(file_name):
+    with metrics.timer("cache_lookup",md5_checksum):
+        exists = cache.exists(md5_checksum,params)
+    metrics.count("cache_lookups_total",result="hit" if exists else "miss")
+    if exists:
         print(f"[.] {query_sequence[:10]} {md5_checksum} Cache found")
     else:
         # Only run blast if allowed to do so
         if cache_only:
             print(f"[!] Only cache is allowed, but sequence {query_sequence[:10]} {md5_checksum}, is not in cache")
-            open(file_name, "w").close()
         else:
             print(f"[.] {query_sequence[:10]} {md5_checksum} Locking cache_file")
-            t = time.time()
-            if remote:
+            if not params.remote:
+                # Local blasts are piped through blastn the same way as batches
+                run_blast_multi({md5_checksum:query_sequence},params,threads)
+                return
+            if not cache.lock_result(md5_checksum,params,blocking=False):
+                print(f"[.] {query_sequence[:10]} {md5_checksum} Another process is blasting it, waiting for it")
+                cache.lock_result(md5_checksum,params)
+            try:
+                if cache.exists(md5_checksum,params):
+                    print(f"[.] {query_sequence[:10]} {md5_checksum} Cache found, blasted by another process")
+                    return
+                cache.start(md5_checksum,params)
+                t = time.time()
                 # Run blast and save result to cache
-                with open(file_name, "w") as file:
-                    print(f"[.] {query_sequence[:10]} Running blast with {len(query_sequence)} BP")
-                    result_handle:io.StringIO = NCBIWWW.qblast(program="blastn",database=db,sequence=query_sequence,megablast=True)
-                    if not isinstance(result_handle,io.StringIO):
-                        raise TypeError(f"result_handle returned type {type(result_handle)} expected io.StringIO")
-                    result =  result_handle.getvalue()
-                    print(f"[.] {query_sequence[:10]} Saving to cache")
-                    file.write(result)
-            else:
-                # Run blast locally
-                with open(f"{md5_checksum}.seq","w") as f:f.write(query_sequence)
-                NcbiblastnCommandline(cmd='blastn',db=db+"/"+db,outfmt=5,out=file_name,query=f"{md5_checksum}.seq",task='megablast')()
-                os.remove(f"{md5_checksum}.seq")
-            print(f"[.] {query_sequence[:10]} Blast took {int(time.time()-t)} seconds")
-
-    if len(open(file_name).read(1))==0:
-        print(f"[!] Cache file at '{file_name}' is empty")
-    blast_records = NCBIXML.parse(open(file_name))
-    return (query_sequence, blast_records)
+                print(f"[.] {query_sequence[:10]} Running blast with {len(query_sequence)} BP")
+                result_handle:io.StringIO = remote_blast.with_backoff(lambda: NCBIWWW.qblast(program=params.program,database=db,sequence=query_sequence,megablast=params.megablast))
+                if not isinstance(result_handle,io.StringIO):
+                    raise TypeError(f"result_handle returned type {type(result_handle)} expected io.StringIO")
+                result =  result_handle.getvalue()
+                metrics.record("qblast",md5_checksum,time.time()-t,queries=1)
+                print(f"[.] {query_sequence[:10]} Saving to cache")
+                cache.write(md5_checksum,params,result)
+                cache.record_runtime(params,len(query_sequence),time.time()-t)
+                print(f"[.] {query_sequence[:10]} Blast took {int(time.time()-t)} seconds")
+            finally:
+                cache.unlock_result(md5_checksum,params)
 
 
 def remove_empty_cache():
     print("[.] Removing empty cache files")
-    # Removes empty files from cache folder
-    for filename in os.listdir(CACHE_FOLDER):
-        if filename.endswith(".xml") and len(filename)==36:
-            file_path = os.path.join(CACHE_FOLDER, filename)
-            # Check if the file is empty
-            if os.path.getsize(file_path) == 0:
-                # Remove the empty XML file
-                try:
-                    os.remove(file_path)
-                    print(f"[.] Removed empty cache file: {file_path}")
-                except Exception as e:
-                    print(f"[.] Couldn't empty cache file: {file_path} due to the following error `{e}` if this error persists, try removing the file manually")
+    # Removes the results of searches which never finished
+    get_cache().remove_incomplete()
+
+
+def open_sequence_file(file_path:str):
+    # Opens a plain, gzip or bzip2 compressed sequence file as text
+    with open(file_path,"rb") as f:
+        magic = f.read(3)
+    if magic.startswith(b"\x1f\x8b"):
+        print(f"[.] Reading gzip compressed '{file_path}'")
+        return io.TextIOWrapper(gzip.open(file_path,"rb"))
+    if magic.startswith(b"BZh"):
+        print(f"[.] Reading bzip2 compressed '{file_path}'")
+        return io.TextIOWrapper(bz2.open(file_path,"rb"))
+    return open(file_path)
 
 
 def parser(file:io.TextIOWrapper):
-    # TODO Implement file type checks
-    # TODO Implement support for other file types
+    # Reads the file one record at a time, so only a single record is kept in memory
     print("[.] Parsing sequences")
     if not isinstance(file,io.TextIOWrapper):
         raise TypeError(f"Got file argument, which is not a type, got {type(file)}")
-    data = file.read().strip()
-    # TODO Make this more stable
-    if data.startswith(">"):
+    file_name = getattr(file,"name","<stream>")
+    lines = (line.rstrip("\r\n") for line in file)
+
+    # The first non empty line tells the file type
+    first_line = next((line for line in lines if line.strip()),"")
+    if first_line.startswith(">"):
         print("[.] Reading fasta file")
-        sections = data.split(">")
-        for section in sections[1:]:
-            metadata, sequence = section.split("\n",1)
-            yield {
-                "metadata":metadata,
-                "sequence":sequence.replace("\n",""),
-            }
-        # This is a fasta file
-    else:
+        metadata = first_line[1:]
+        sequence:list[str] = []
+        for line in lines:
+            if line.startswith(">"):
+                yield {
+                    "metadata":metadata,
+                    "sequence":"".join(sequence),
+                }
+                metadata = line[1:]
+                sequence = []
+            else:
+                sequence.append(line.strip())
+        yield {
+            "metadata":metadata,
+            "sequence":"".join(sequence),
+        }
+    elif first_line:
         print("[.] Reading fastq file")
-        # This is a fastq file ???
-        lines = data.splitlines()
-        if len(lines)%4!=0:
-            raise ValueError(f"Line count of '{file.name}' must be divideable by 4, line count {len(lines)}")
-        for i in range(len(lines)//4):
-            sequence = lines[4*i+1]
+        metadata = first_line
+        while metadata:
+            record = [metadata]+[next(lines,None) for _ in range(3)]
+            if None in record:
+                raise ValueError(f"Last record of '{file_name}' is truncated, fastq records must be 4 lines")
+            sequence = record[1]
             if not set(sequence).issubset(ALLOWED_BASES):
                 raise ValueError(f"Got a sequence containing {set(sequence)}, which is not a subset of {ALLOWED_BASES}")
             yield {
-                "metadata":lines[4*i],
+                "metadata":record[0],
                 "sequence":sequence,
-                "plus":lines[4*i+2],
-                "some_other_data":lines[4*i+3]
+                "plus":record[2],
+                "some_other_data":record[3]
             }
+            metadata = next((line for line in lines if line.strip()),"")
 
 
 def get_sequence(file:io.TextIOWrapper):
-    sequences:list[Seq] = []
+    # Yields the sequences lazily, so blasting can start before the whole file is read
     for i,data in enumerate(parser(file=file)):
         if "sequence" in data:
             sequence = data["sequence"]
-            sequences.append(Seq(sequence))
             print(i,sequence[:10])
-    return sequences
+            yield Seq(sequence)
 
 
 if __name__=="__main__":
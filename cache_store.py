@@ -0,0 +1,434 @@
+from typing import NamedTuple
+import threading
+import sqlite3
+import hashlib
+import errno
+import zlib
+import uuid
+import time
+import os
+import io
+import re
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+INDEX_FNAME = "index.sqlite3"
+PACK_FOLDER = "packs"
+# A new pack file is started once the current one is larger than this
+PACK_SIZE = 1024**3
+# Processes searching for a result hold a lock file in this folder, so other processes wait for them instead of searching again
+LOCK_FOLDER = "locks"
+# Appending to the pack files is serialized between processes by this lock file in the pack folder
+PACK_LOCK_FNAME = ".lock"
+# Seconds between attempts to take a lock, where locks can't be waited for
+LOCK_POLL_INTERVAL = 0.5
+
+
+class SearchParams(NamedTuple):
+    # Everything besides the sequence which changes the result of a search
+    db:str
+    remote:bool
+    program:str = "blastn"
+    megablast:bool = True
+    # 5 is blast xml, 6 is the tabular format of blaster.TABULAR_OUTFMT
+    outfmt:int = 5
+
+
+class FileLock:
+    # An exclusive advisory lock on a file, held against other processes, including ones on other nodes sharing the folder over NFS
+    # The locks belong to the process, so they don't keep the threads of one process apart
+    def __init__(self, path:str):
+        self.path = path
+        self.file:io.BufferedRandom|None = None
+
+    def acquire(self, blocking=True):
+        # Returns whether the lock was taken, which is always the case when blocking
+        while True:
+            f = open(self.path,"a+b")
+            try:
+                locked = lock_file(f,blocking)
+            except BaseException:
+                f.close()
+                raise
+            if not locked:
+                f.close()
+                return False
+            # The previous holder may have removed the file while this waited, then the lock is on a file nobody else can see
+            try:
+                same_file = os.path.samestat(os.fstat(f.fileno()),os.stat(self.path))
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                self.file = f
+                return True
+            f.close()
+
+    def release(self, remove=True):
+        # The file is removed while still locked, so it doesn't pile up, Windows can't remove open files so they are left
+        if self.file is None:
+            return
+        if remove and os.name != 'nt':
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        unlock_file(self.file)
+        self.file.close()
+        self.file = None
+
+
+def lock_file(f:io.BufferedRandom, blocking:bool):
+    # Returns whether the lock was taken, which is always the case when blocking
+    # The lock is only ever tried, and tried again a while later, as the kernel refuses to let a process wait for a lock of another
+    # multi threaded process with EDEADLK, for deadlocks between threads which can't happen, since locks belong to whole processes
+    while True:
+        try:
+            if fcntl is not None:
+                # lockf rather than flock, as only lockf locks are seen by other NFS clients
+                fcntl.lockf(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(),msvcrt.LK_NBLCK,1)
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EACCES,errno.EAGAIN,errno.EDEADLK):
+                raise
+        if not blocking:
+            return False
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+def unlock_file(f:io.BufferedRandom):
+    if fcntl is not None:
+        fcntl.lockf(f,fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(),msvcrt.LK_UNLCK,1)
+
+
+class CacheStore:
+    # Blast results indexed by sequence checksum and search parameters
+    # The results are sharded into folder/ab/cd/abcd...xml, so no folder grows too large
+    # If packed, results are instead appended compressed to folder/packs/*.pack and read back with a single seek
+    # Several processes may share the folder, also from other nodes over NFS if shared, as sqlite can't use its write-ahead log there
+    def __init__(self, folder:str, packed=False, shared=False):
+        self.folder = folder
+        self.packed = packed
+        if not os.path.exists(folder):os.makedirs(folder,exist_ok=True)
+        index_path = os.path.join(folder,INDEX_FNAME)
+        new_index = not os.path.exists(index_path)
+        self.lock = threading.Lock()
+        # The results this process is searching for, by key, None while the lock is being taken
+        self.held:dict[str,FileLock|None] = dict()
+        self.connection = sqlite3.connect(index_path,timeout=60,check_same_thread=False,isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=DELETE" if shared else "PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                checksum TEXT NOT NULL,
+                db TEXT NOT NULL,
+                remote INTEGER NOT NULL,
+                program TEXT NOT NULL,
+                megablast INTEGER NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                status TEXT NOT NULL,
+                pack INTEGER,
+                offset INTEGER,
+                length INTEGER,
+                codec TEXT,
+                outfmt INTEGER NOT NULL DEFAULT 5
+            )""")
+        # Hit summaries, so formatting a result doesn't require parsing the xml again
+        self.connection.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, query_length INTEGER)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS hits (
+                key TEXT NOT NULL,
+                hit INTEGER NOT NULL,
+                accession TEXT NOT NULL,
+                title TEXT NOT NULL,
+                length INTEGER,
+                coverage INTEGER NOT NULL,
+                PRIMARY KEY (key,hit)
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS hsps (
+                key TEXT NOT NULL,
+                hit INTEGER NOT NULL,
+                hsp INTEGER NOT NULL,
+                identities INTEGER,
+                align_length INTEGER,
+                query_start INTEGER,
+                query_end INTEGER,
+                PRIMARY KEY (key,hit,hsp)
+            )""")
+        # How long past searches took, to estimate how long new ones will take
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS runtimes (
+                db TEXT NOT NULL,
+                remote INTEGER NOT NULL,
+                program TEXT NOT NULL,
+                megablast INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                created REAL NOT NULL
+            )""")
+        # Older indexes get the columns added since, and new ones the legacy files, one process at a time,
+        # as processes sharing the folder all start at once
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]
+            for column,definition in (("pack","INTEGER"),("offset","INTEGER"),("length","INTEGER"),("codec","TEXT"),("outfmt","INTEGER NOT NULL DEFAULT 5")):
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE results ADD COLUMN {column} {definition}")
+            if new_index:
+                self.migrate_legacy()
+
+    def execute(self, sql:str, parameters:tuple=()):
+        with self.lock:
+            return self.connection.execute(sql,parameters).fetchall()
+
+    def key(self, checksum:str, params:SearchParams):
+        # The key is the checksum of the sequence checksum and the search parameters
+        # outfmt was added later, and is left out for xml so existing keys stay the same
+        fields = tuple(params) if params.outfmt != 5 else tuple(params)[:-1]
+        return hashlib.md5("|".join(map(str,(checksum,)+fields)).encode()).hexdigest()
+
+    def path(self, key:str):
+        return os.path.join(self.folder,key[:2],key[2:4],f"{key}.xml")
+
+    def status(self, checksum:str, params:SearchParams):
+        # Returns the status of the result, or None if it isn't in the cache
+        rows = self.execute("SELECT status FROM results WHERE key=?",(self.key(checksum,params),))
+        return rows[0][0] if rows else None
+
+    def exists(self, checksum:str, params:SearchParams):
+        return self.status(checksum,params) == "done"
+
+    def start(self, checksum:str, params:SearchParams):
+        # Marks the result as being searched for
+        key = self.key(checksum,params)
+        self.execute(
+            "INSERT OR REPLACE INTO results (key,checksum,db,remote,program,megablast,outfmt,created,status) VALUES (?,?,?,?,?,?,?,?,?)",
+            (key,checksum,params.db,int(params.remote),params.program,int(params.megablast),params.outfmt,time.time(),"pending"),
+        )
+
+    def lock_result(self, checksum:str, params:SearchParams, blocking=True):
+        # Locks the result against other processes searching for it, returns False if not blocking and it is already locked
+        # A result being searched for by another thread of this process counts as locked, those threads are kept apart by blaster
+        return self.lock_key(self.key(checksum,params),blocking)
+
+    def unlock_result(self, checksum:str, params:SearchParams):
+        # Unlocks a result locked by lock_result, does nothing if this process doesn't hold it
+        self.unlock_key(self.key(checksum,params))
+
+    def lock_key(self, key:str, blocking=True):
+        # The key is reserved first, so this process never has two files open on one lock, as closing either would drop the lock
+        while True:
+            with self.lock:
+                if key not in self.held:
+                    self.held[key] = None
+                    break
+            if not blocking:
+                return False
+            time.sleep(LOCK_POLL_INTERVAL)
+        lock = None
+        try:
+            os.makedirs(os.path.join(self.folder,LOCK_FOLDER),exist_ok=True)
+            lock = FileLock(os.path.join(self.folder,LOCK_FOLDER,f"{key}.lock"))
+            if not lock.acquire(blocking):
+                lock = None
+        finally:
+            with self.lock:
+                if lock is None:
+                    del self.held[key]
+                else:
+                    self.held[key] = lock
+        return lock is not None
+
+    def unlock_key(self, key:str):
+        with self.lock:
+            lock = self.held.get(key)
+            if lock is None:
+                return
+            del self.held[key]
+        lock.release()
+
+    def write(self, checksum:str, params:SearchParams, xml:str):
+        key = self.key(checksum,params)
+        pack = offset = length = codec = None
+        if self.packed:
+            pack, offset, length, codec = self.append_to_pack(xml)
+        else:
+            # Written next to its place and renamed into it, so other processes never read a partly written result
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(temporary_path,"w") as f:
+                    f.write(xml)
+                os.replace(temporary_path,path)
+            except BaseException:
+                if os.path.exists(temporary_path):os.remove(temporary_path)
+                raise
+        self.execute(
+            "INSERT OR REPLACE INTO results (key,checksum,db,remote,program,megablast,outfmt,size,created,status,pack,offset,length,codec) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            (key,checksum,params.db,int(params.remote),params.program,int(params.megablast),params.outfmt,len(xml),time.time(),"done",pack,offset,length,codec),
+        )
+        # The summary of an older result is no longer valid
+        self.execute("DELETE FROM summaries WHERE key=?",(key,))
+
+    def read(self, checksum:str, params:SearchParams):
+        # Returns the cached xml as a file, or None if it isn't in the cache
+        rows = self.execute("SELECT status,pack,offset,length,codec FROM results WHERE key=?",(self.key(checksum,params),))
+        if not rows or rows[0][0] != "done":
+            return None
+        _, pack, offset, length, codec = rows[0]
+        if pack is None:
+            return open(self.path(self.key(checksum,params)))
+        with open(self.pack_path(pack),"rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return io.StringIO(decompress(data,codec).decode())
+
+    def write_summary(self, checksum:str, params:SearchParams, summary:tuple):
+        # Stores a summary from blaster.summarize_record
+        key = self.key(checksum,params)
+        query_length, hits = summary
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.execute("DELETE FROM hits WHERE key=?",(key,))
+                self.connection.execute("DELETE FROM hsps WHERE key=?",(key,))
+                self.connection.executemany(
+                    "INSERT INTO hits (key,hit,accession,title,length,coverage) VALUES (?,?,?,?,?,?)",
+                    [(key,i,acc,title,length,coverage) for i,(acc,title,length,coverage,_) in enumerate(hits)],
+                )
+                self.connection.executemany(
+                    "INSERT INTO hsps (key,hit,hsp,identities,align_length,query_start,query_end) VALUES (?,?,?,?,?,?,?)",
+                    [(key,i,j)+tuple(hsp) for i,hit in enumerate(hits) for j,hsp in enumerate(hit[4])],
+                )
+                self.connection.execute("INSERT OR REPLACE INTO summaries (key,query_length) VALUES (?,?)",(key,query_length))
+
+    def read_summary(self, checksum:str, params:SearchParams):
+        # Returns the summary in the format of blaster.summarize_record, or None if it isn't stored
+        key = self.key(checksum,params)
+        rows = self.execute("SELECT query_length FROM summaries WHERE key=?",(key,))
+        if not rows:
+            return None
+        query_length = rows[0][0]
+        hsps:dict[int,list[tuple]] = dict()
+        for hit,identities,align_length,query_start,query_end in self.execute("SELECT hit,identities,align_length,query_start,query_end FROM hsps WHERE key=? ORDER BY hit,hsp",(key,)):
+            hsps.setdefault(hit,[]).append((identities,align_length,query_start,query_end))
+        hits = [
+            (accession,title,length,coverage,hsps.get(hit,[]))
+            for hit,accession,title,length,coverage in self.execute("SELECT hit,accession,title,length,coverage FROM hits WHERE key=? ORDER BY hit",(key,))
+        ]
+        return query_length, hits
+
+    def record_runtime(self, params:SearchParams, length:int, seconds:float):
+        self.execute(
+            "INSERT INTO runtimes (db,remote,program,megablast,length,seconds,created) VALUES (?,?,?,?,?,?,?)",
+            (params.db,int(params.remote),params.program,int(params.megablast),length,seconds,time.time()),
+        )
+
+    def runtimes(self, params:SearchParams, limit:int=1000):
+        # Returns the (length, seconds) of the latest searches with the parameters
+        return self.execute(
+            "SELECT length,seconds FROM runtimes WHERE db=? AND remote=? AND program=? AND megablast=? ORDER BY created DESC LIMIT ?",
+            (params.db,int(params.remote),params.program,int(params.megablast),limit),
+        )
+
+    def pack_path(self, pack:int):
+        return os.path.join(self.folder,PACK_FOLDER,f"{pack:06d}.pack")
+
+    def append_to_pack(self, xml:str):
+        # Appends the compressed xml to the newest pack file, and returns where it was put
+        # Other processes append to the same pack files, so the end of the file is only read once they are locked out
+        codec = "zstd" if zstandard is not None else "zlib"
+        data = compress(xml.encode(),codec)
+        with self.lock:
+            os.makedirs(os.path.join(self.folder,PACK_FOLDER),exist_ok=True)
+            pack_lock = FileLock(os.path.join(self.folder,PACK_FOLDER,PACK_LOCK_FNAME))
+            pack_lock.acquire()
+            try:
+                pack = self.connection.execute("SELECT MAX(pack) FROM results").fetchone()[0] or 0
+                while os.path.exists(self.pack_path(pack)) and os.path.getsize(self.pack_path(pack)) > PACK_SIZE:
+                    pack += 1
+                with open(self.pack_path(pack),"ab") as f:
+                    offset = f.seek(0,os.SEEK_END)
+                    f.write(data)
+            finally:
+                pack_lock.release(remove=False)
+        return pack, offset, len(data), codec
+
+    def remove_incomplete(self):
+        # Removes results from searches that never finished, using the index instead of listing the folder
+        # Pack files are append only, so there is only something to remove for unpacked results
+        # Searches still running in this or another process hold their lock, and are left alone
+        for key, in self.execute("SELECT key FROM results WHERE status!='done'"):
+            path = self.path(key)
+            if not self.lock_key(key,blocking=False):
+                print(f"[.] Cache entry {key} is being searched for")
+                continue
+            try:
+                # The search may have finished while the lock was taken
+                if self.execute("SELECT status FROM results WHERE key=?",(key,)) != [("done",)]:
+                    if os.path.exists(path):os.remove(path)
+                    self.execute("DELETE FROM results WHERE key=? AND status!='done'",(key,))
+                    print(f"[.] Removed incomplete cache entry: {key}")
+            except Exception as e:
+                print(f"[.] Couldn't remove cache entry: {path} due to the following error `{e}` if this error persists, try removing the file manually")
+            finally:
+                self.unlock_key(key)
+
+    def migrate_legacy(self):
+        # Moves flat folder/{md5}.xml files into the index, their parameters are read from the xml header
+        for filename in os.listdir(self.folder):
+            if not (filename.endswith(".xml") and len(filename)==36):
+                continue
+            file_path = os.path.join(self.folder,filename)
+            with open(file_path) as f:
+                header = f.read(4096)
+            program = re.search(r"<BlastOutput_program>(.*?)</BlastOutput_program>",header)
+            db = re.search(r"<BlastOutput_db>(.*?)</BlastOutput_db>",header)
+            if program is None or db is None:
+                print(f"[!] Couldn't read the header of legacy cache file: {file_path}, leaving it as is")
+                continue
+            # Local blasts were run against the db at {db}/{db}
+            remote = "/" not in db.group(1)
+            params = SearchParams(db=db.group(1).split("/")[-1],remote=remote,program=program.group(1))
+            checksum = filename[:-4]
+            with open(file_path) as f:
+                self.write(checksum,params,f.read())
+            os.remove(file_path)
+            print(f"[.] Migrated legacy cache file: {file_path}")
+
+
+def compress(data:bytes, codec:str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("Compressing with zstd requires zstandard, install it with 'pip install zstandard'")
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == "zlib":
+        return zlib.compress(data)
+    raise ValueError(f"Unknown codec '{codec}'")
+
+
+def decompress(data:bytes, codec:str):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed cache requires zstandard, install it with 'pip install zstandard'")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown codec '{codec}'")
@@ -0,0 +1,217 @@
+from typing import Iterable
+import threading
+import argparse
+import hashlib
+import signal
+import heapq
+import json
+import csv
+import sys
+import os
+import re
+
+import blaster
+from result_writer import ResultWriter,FORMATS
+from metrics import metrics
+
+# The output file is written through a buffer of this size
+OUTPUT_BUFFER_SIZE = 1<<20
+
+
+def shard(value:str):
+    # Parses "i/N", the i'th of N shards, counting from 0
+    match = re.fullmatch(r"(\d+)/(\d+)",value)
+    if match is None or not int(match[1]) < int(match[2]):
+        raise argparse.ArgumentTypeError(f"expected i/N with 0 <= i < N, not '{value}'")
+    return int(match[1]), int(match[2])
+
+
+def workers(value:str):
+    # "auto" lets blast_batch pick the processes and threads of local runs
+    if value.strip().lower() == "auto":
+        return None
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer or auto, not '{value}'")
+    return int(value)
+
+
+def in_shard(query_sequence:str, index:int, count:int):
+    # Sequences are split by their MD5 sum, the key of the cache, so every node agrees on the split without talking to the others,
+    # and identical sequences always end up on the same node
+    return int(hashlib.md5(query_sequence.encode()).hexdigest(),16)%count == index
+
+
+def read_sequences(options:argparse.Namespace, positions:list[int]):
+    # Yields the sequences of the shard, and appends the position of each in the whole input to positions
+    index, count = options.shard
+    for position,query_sequence in enumerate(blaster.get_sequence(blaster.open_sequence_file(options.input))):
+        if count == 1 or in_shard(str(query_sequence),index,count):
+            positions.append(position)
+            yield query_sequence
+
+
+def shard_suffix(options:argparse.Namespace):
+    index, count = options.shard
+    return f".{index}of{count}" if count != 1 else ""
+
+
+def batch_options(options:argparse.Namespace):
+    # The keyword arguments of blast_batch
+    manifest = options.manifest
+    if manifest is None and options.resume:
+        manifest = f"{options.input}{shard_suffix(options)}.jobs"
+    return dict(db=options.db,remote=not options.local,cache_only=options.cache_only,workers=options.workers,batch_size=options.batch_size,
+        batch_length=options.batch_length,engine=options.engine,order=options.order,threads=options.threads,tabular=options.tabular,manifest=manifest)
+
+
+def output_path(options:argparse.Namespace):
+    if options.output is not None:
+        return options.output
+    return f"{options.input}{shard_suffix(options)}.{'txt' if options.format == 'text' else options.format}"
+
+
+def write_results(results:Iterable[tuple[int,str,tuple]], options:argparse.Namespace, positions:list[int]):
+    # Writes (position, sequence, summary) of the shard, numbered by their position in the whole input
+    path = output_path(options)
+    written = 0
+    with open(path,"w",buffering=OUTPUT_BUFFER_SIZE) as f:
+        writer = ResultWriter(f,options.format,options.alignments,options.hsps) if options.format != "text" else None
+        for position, query_sequence, summary in results:
+            md5_checksum = hashlib.md5(query_sequence.encode()).hexdigest()
+            with metrics.timer("format",md5_checksum):
+                if writer is not None:
+                    writer.write(positions[position],query_sequence,md5_checksum,summary)
+                else:
+                    for acc, qc, match, bp, title in blaster.summary_formatter(summary,options.alignments,options.hsps):
+                        f.write("  ".join(map(str,(query_sequence[:10], str(len(query_sequence)).rjust(6," "), acc, qc, match, str(bp).rjust(10," "), title)))+"\n")
+            written += 1
+    print(f"[.] Wrote the results of {written} sequences to '{path}'")
+
+
+def process(options:argparse.Namespace, cancel:threading.Event):
+    positions:list[int] = []
+    completed = sum(1 for _ in blaster.blast_batch(read_sequences(options,positions),cancel=cancel,**batch_options(options)))
+    print(f"[.] Processed {completed} of the {len(positions)} sequences read")
+
+
+def parse(options:argparse.Namespace, cancel:threading.Event):
+    positions:list[int] = []
+    summaries = blaster.summary_batch(read_sequences(options,positions),db=options.db,remote=not options.local,workers=options.parse_workers,tabular=options.tabular,cancel=cancel)
+    write_results(((position,query_sequence,summary) for position,(query_sequence,summary) in enumerate(summaries)),options,positions)
+
+
+def process_and_parse(options:argparse.Namespace, cancel:threading.Event):
+    positions:list[int] = []
+    results = blaster.blast_summaries(read_sequences(options,positions),ordered=not options.unordered,cancel=cancel,**batch_options(options))
+    write_results(results,options,positions)
+
+
+def merge(options:argparse.Namespace):
+    # Merges the ordered outputs of the shards into one file in input order, by their query column
+    # Outputs written with --unordered can't be merged, which is noticed by their query column going back, and the merge stops
+    files = [open(path,newline="") for path in options.files]
+    delimiter = "\t" if options.format == "tsv" else ","
+    def rows(f, path:str):
+        items = ((json.loads(line)["query"], line) for line in f) if options.format == "jsonl" else ((int(row[0]), row) for row in readers[f])
+        last = 0
+        for query, row in items:
+            if query < last:
+                raise ValueError(f"'{path}' is not in input order, query {query} comes after {last}, outputs written with --unordered can't be merged")
+            last = query
+            yield query, row
+    try:
+        readers = {f:csv.reader(f,delimiter=delimiter) for f in files} if options.format != "jsonl" else dict()
+        headers = [next(reader,None) for reader in readers.values()]
+        with open(options.output,"w",newline="",buffering=OUTPUT_BUFFER_SIZE) as out:
+            writer = csv.writer(out,delimiter=delimiter,lineterminator="\n") if options.format != "jsonl" else None
+            if writer is not None and len(headers) != 0:
+                writer.writerow(headers[0])
+            for _, row in heapq.merge(*map(rows,files,options.files),key=lambda item: item[0]):
+                if writer is None:
+                    out.write(row)
+                else:
+                    writer.writerow(row)
+    except ValueError as e:
+        # The partial output is removed, so it isn't mistaken for a finished merge
+        if os.path.exists(options.output):os.remove(options.output)
+        sys.exit(f"[!] {e}")
+    finally:
+        for f in files:
+            f.close()
+    print(f"[.] Merged {len(files)} files into '{options.output}'")
+
+
+def cancel_on_signals(cancel:threading.Event):
+    # The first interrupt, or a SIGTERM from a scheduler, lets the sequences already started finish, the second stops right away
+    def handler(signum, frame):
+        if cancel.is_set():
+            raise KeyboardInterrupt
+        print("[!] Stopping once the sequences already started are done, interrupt again to stop right away",file=sys.stderr)
+        cancel.set()
+    signal.signal(signal.SIGINT,handler)
+    if hasattr(signal,"SIGTERM"):
+        signal.signal(signal.SIGTERM,handler)
+
+
+def main(argv:list[str]|None=None):
+    arg_parser = argparse.ArgumentParser(description="Blasts the sequences of a fasta or fastq file, and parses the results, without the GUI")
+    commands = arg_parser.add_subparsers(dest="command",required=True)
+    blast_parsers = []
+    for command, description in (("process","blast the sequences into the cache"),("parse","write the cached results of the sequences"),("process-and-parse","blast the sequences and write each result as soon as it is done")):
+        command_parser = commands.add_parser(command,help=description,description=description)
+        command_parser.add_argument("input",help="fasta or fastq file, optionally gzip or bz2 compressed")
+        command_parser.add_argument("--db",default="nr",help="db to blast against, a local db is the name of its folder")
+        command_parser.add_argument("--local",action="store_true",help="blast against a local db with blastn instead of the NCBI servers")
+        command_parser.add_argument("--tabular",action="store_true",help="have local blastn write its compact tabular output instead of xml")
+        command_parser.add_argument("--cache",default=blaster.CACHE_FOLDER,help="cache folder, which may be shared by several processes")
+        command_parser.add_argument("--shared-cache",action="store_true",help="the cache folder is shared by several nodes over NFS")
+        command_parser.add_argument("--shard",type=shard,default=(0,1),help="only take the sequences of shard i of N, split by the MD5 sum of the sequence, e.g. 0/4")
+        command_parser.add_argument("--metrics-log",help="append the seconds each sequence spent in each stage to this file as lines of JSON")
+        command_parser.add_argument("--metrics-file",help="keep Prometheus metrics of the run in this file")
+        command_parser.add_argument("--metrics-port",type=int,help="serve Prometheus metrics of the run at http://localhost:port/metrics")
+        if command != "parse":
+            blast_parsers.append(command_parser)
+        if command != "process":
+            command_parser.add_argument("--output",help="output file, by default the input file with the shard and the format appended")
+            command_parser.add_argument("--format",choices=("text",)+FORMATS,default="tsv",help="text is the format of the GUI, the others have a row per hit")
+            command_parser.add_argument("--alignments",type=int,default=1,help="hits written per sequence")
+            command_parser.add_argument("--hsps",type=int,default=1,help="high scoring pairs written per hit")
+        if command == "parse":
+            command_parser.add_argument("--parse-workers",type=int,default=os.cpu_count() or 1,help="processes parsing the xml results")
+        if command == "process-and-parse":
+            command_parser.add_argument("--unordered",action="store_true",help="write the results as they are done, instead of in input order")
+    for command_parser in blast_parsers:
+        command_parser.add_argument("--email",help="contact email sent to NCBI with remote searches")
+        command_parser.add_argument("--cache-only",action="store_true",help="only use results which are already cached, never blast")
+        command_parser.add_argument("--workers",type=workers,default=1,help="concurrent blasts or outstanding remote searches, auto picks them for local runs")
+        command_parser.add_argument("--threads",type=int,default=1,help="threads of each local blastn")
+        command_parser.add_argument("--batch-size",type=int,default=1,help="queries per blastn invocation or remote search")
+        command_parser.add_argument("--batch-length",type=int,help="most bases per batch")
+        command_parser.add_argument("--engine",choices=("threads","async"),default="threads",help="async runs remote searches from one event loop")
+        command_parser.add_argument("--order",choices=("input","longest"),default="input",help="longest starts the sequences estimated to take the longest first")
+        command_parser.add_argument("--manifest",help="job manifest, sequences done by an earlier run with the same manifest are not blasted again")
+        command_parser.add_argument("--resume",action="store_true",help="keep a job manifest next to the input file, per shard")
+    merge_parser = commands.add_parser("merge",help="merge the outputs of the shards in input order",description="merge the tsv, csv or jsonl outputs of the shards in input order")
+    merge_parser.add_argument("files",nargs="+")
+    merge_parser.add_argument("--output",required=True)
+    merge_parser.add_argument("--format",choices=FORMATS,default="tsv")
+    options = arg_parser.parse_args(argv)
+
+    if options.command == "merge":
+        merge(options)
+        return
+    blaster.CACHE_FOLDER = options.cache
+    blaster.CACHE_SHARED = options.shared_cache
+    if getattr(options,"email",None) is not None:
+        blaster.NCBIWWW.email = options.email
+    metrics.configure(options.metrics_log,options.metrics_file,options.metrics_port)
+    cancel = threading.Event()
+    cancel_on_signals(cancel)
+    {"process":process,"parse":parse,"process-and-parse":process_and_parse}[options.command](options,cancel)
+    if cancel.is_set():
+        print("[!] Stopped early, run it again to continue")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import contextlib
+import socket
+import shutil
+import ctypes
+import uuid
+import time
+import os
+
+# The versions of db 'nt' are kept in 'nt.versions/<version>', and 'nt' is a symlink to the current one
+VERSIONS_SUFFIX = ".versions"
+# A version is built in a folder with this prefix, and renamed once all its volumes are in place
+BUILDING_PREFIX = ".building."
+# Running blasts keep a lease file in this folder, so the version they use isn't removed under them
+# Leases are named <version>.<host>.<pid>.<random>, as the folder may be shared by several nodes
+LEASES_FOLDER = ".leases"
+# The version name of a db which was installed in place, before versions
+LEGACY_VERSION = "00000000-000000"
+# Number of the newest versions kept, up to and including the current one
+KEEP_VERSIONS = 2
+
+
+def versions_folder(name:str):
+    return name+VERSIONS_SUFFIX
+
+
+def current_version(name:str):
+    # Returns the folder of the current version of the db, or None if the db isn't versioned
+    if os.path.islink(name):
+        return os.path.realpath(name)
+    return None
+
+
+def building_folder(name:str):
+    # Returns the folder to build a new version in, a version which was never finished is built further
+    folder = versions_folder(name)
+    if not os.path.exists(folder):os.mkdir(folder)
+    for fname in sorted(os.listdir(folder)):
+        if fname.startswith(BUILDING_PREFIX):
+            return os.path.join(folder,fname)
+    path = os.path.join(folder,BUILDING_PREFIX+time.strftime("%Y%m%d-%H%M%S"))
+    os.mkdir(path)
+    return path
+
+
+def activate(name:str, building:str):
+    # Finishes the version built in building, and points the db at it with a single atomic rename
+    folder = versions_folder(name)
+    version = os.path.join(folder,os.path.basename(building)[len(BUILDING_PREFIX):])
+    os.rename(building,version)
+    if os.path.isdir(name) and not os.path.islink(name):
+        # A db installed in place is moved in with the versions, so the link can take its place
+        os.rename(name,os.path.join(folder,LEGACY_VERSION))
+    link = os.path.join(folder,".link")
+    if os.path.lexists(link):os.remove(link)
+    try:
+        os.symlink(os.path.relpath(version,os.path.dirname(name) or "."),link,target_is_directory=True)
+    except (OSError,NotImplementedError):
+        # Without symlinks, e.g. on Windows without developer mode, the new version is renamed into place instead
+        if os.path.exists(name):os.rename(name,os.path.join(folder,time.strftime("%Y%m%d-%H%M%S")+".previous"))
+        os.rename(version,name)
+        print(f"[!] Couldn't make a symlink, '{name}' was replaced by renaming")
+        return
+    os.replace(link,name)
+    print(f"[.] '{name}' now points at version '{os.path.basename(version)}'")
+
+
+@contextlib.contextmanager
+def use(name:str):
+    # Yields the folder of the current version of the db, which isn't removed until the with block is left
+    version = current_version(name)
+    if version is None:
+        yield name
+        return
+    leases = os.path.join(versions_folder(name),LEASES_FOLDER)
+    if not os.path.exists(leases):os.makedirs(leases,exist_ok=True)
+    while True:
+        lease = os.path.join(leases,f"{os.path.basename(version)}.{lease_host()}.{os.getpid()}.{uuid.uuid4().hex}")
+        open(lease,"w").close()
+        # The version is looked up again once the lease exists, as an update may have switched and removed it in between
+        current = current_version(name)
+        if current == version:
+            break
+        os.remove(lease)
+        if current is None:
+            yield name
+            return
+        version = current
+    try:
+        yield version
+    finally:
+        try:
+            os.remove(lease)
+        except OSError:
+            pass
+
+
+def remove_old_versions(name:str, keep:int=KEEP_VERSIONS):
+    # Removes the versions older than the newest keep, unless a running blast still uses them
+    folder = versions_folder(name)
+    current = current_version(name)
+    if current is None or not os.path.exists(folder):
+        return
+    versions = sorted(fname for fname in os.listdir(folder) if not fname.startswith("."))
+    kept = set(versions[:versions.index(os.path.basename(current))+1][-keep:]) if os.path.basename(current) in versions else set()
+
+    # Leases of processes on this host which have exited are left over, and removed
+    # Whether the processes of other hosts are running can't be told from here, so their leases are always kept
+    leased = set()
+    leases = os.path.join(folder,LEASES_FOLDER)
+    for lease in os.listdir(leases) if os.path.exists(leases) else []:
+        parts = lease.split(".")
+        # Leases from before the host was part of the name have no host, and are kept too
+        if len(parts) == 4 and parts[1] == lease_host() and parts[2].isdigit() and not pid_alive(int(parts[2])):
+            os.remove(os.path.join(leases,lease))
+        else:
+            leased.add(parts[0])
+
+    for version in versions:
+        if version in kept:
+            continue
+        if version in leased:
+            print(f"[.] Keeping version '{version}' of '{name}', it is still in use")
+            continue
+        print(f"[.] Removing version '{version}' of '{name}'")
+        shutil.rmtree(os.path.join(folder,version))
+
+
+def lease_host():
+    # The host name, without dots, so lease names can be split on them
+    return socket.gethostname().replace(".","_") or "localhost"
+
+
+def pid_alive(pid:int):
+    # Whether the process with the pid is running
+    if os.name == 'nt':
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000,False,pid)
+        if not handle:return False
+        exit_code = ctypes.c_ulong(0)
+        ctypes.windll.kernel32.GetExitCodeProcess(handle,ctypes.byref(exit_code))
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return exit_code.value == 259
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -1,10 +1,16 @@
 import tkinter as tk
 from tkinter import messagebox,filedialog
 from typing import Callable,Literal
+import threading
+import traceback
 import datetime
+import hashlib
+import queue
+import time
 import os
 
 import blaster
+from result_writer import ResultWriter
 
 
 # Modify custom_parsing as you wish :D
@@ -16,26 +22,152 @@ def custom_parsing(sequence:str, query_coverage:str|Literal["?%"], accession_num
 NUMBER_OF_ALIGNMENTS = 1
 # MAX_HIGH_SCORING_PAIRS may also be adjusted as needed, can range between 1 and 99999, hopefully
 MAX_HIGH_SCORING_PAIRS = 1
-
-
-def process(file_path:str, db:str, concurrent_requests:int):
-    sequences = blaster.get_sequence(open(file_path))
-    for _ in blaster.blast_batch(query_sequences=sequences,db=db,cache_only=False,workers=concurrent_requests,remote=False):
-        pass
-
-
-def parse(file_path:str):
-    sequences = blaster.get_sequence(open(file_path))
-    for seq,records in blaster.blast_batch(sequences,db=None,cache_only=True,remote=False):
-        record = next(records)
-        
-        for acc, qc, match, bp, title in blaster.record_formatter(record,number_of_alignments=NUMBER_OF_ALIGNMENTS,max_high_scoring_pairs=MAX_HIGH_SCORING_PAIRS):
-            custom_parsing(seq, qc, acc, match, bp, title)
-
-
-def process_and_parse(file_path:str, db:str, concurrent_requests:int):
-    process(file_path=file_path,db=db,concurrent_requests=concurrent_requests)
-    parse(file_path=file_path)
+# TABULAR makes blastn write its compact tabular output instead of xml, results cached as xml are not reused
+TABULAR = False
+# METRICS_LOG appends the seconds each sequence spent in each stage as lines of JSON, and METRICS_FILE keeps Prometheus metrics of the run, None disables them
+METRICS_LOG = None
+METRICS_FILE = None
+# OUTPUT_FORMAT "text" writes with custom_parsing, "tsv", "csv" and "jsonl" write a row per hit with the columns of result_writer.COLUMNS
+OUTPUT_FORMAT = "text"
+# ORDERED_OUTPUT writes the results of Process & Parse in the order of the input file, instead of as soon as each is done
+ORDERED_OUTPUT = True
+
+
+def process(file_path:str, db:str, concurrent_requests:int|None):
+    report("Processing",0)
+    sequences = read_sequences(file_path)
+    for completed,_ in enumerate(blaster.blast_batch(query_sequences=sequences,db=db,cache_only=False,workers=concurrent_requests,remote=False,tabular=TABULAR,cancel=cancel),1):
+        report("Processing",completed)
+
+
+def parse(file_path:str, db:str):
+    report("Parsing",0)
+    sequences = read_sequences(file_path)
+    for position,(seq,summary) in enumerate(blaster.summary_batch(sequences,db=db,remote=False,workers=os.cpu_count() or 1,tabular=TABULAR,cancel=cancel)):
+        write_result(position,seq,summary)
+        report("Parsing",position+1)
+
+
+def process_and_parse(file_path:str, db:str, concurrent_requests:int|None):
+    # Each result is parsed and written as soon as its blast is done, in a single pass over the input
+    report("Processing & parsing",0)
+    sequences = read_sequences(file_path)
+    for completed,(position,seq,summary) in enumerate(blaster.blast_summaries(sequences,db=db,remote=False,ordered=ORDERED_OUTPUT,cache_only=False,workers=concurrent_requests,tabular=TABULAR,cancel=cancel),1):
+        write_result(position,seq,summary)
+        report("Processing & parsing",completed)
+
+
+def write_result(position:int, seq:str, summary:tuple):
+    global result_writer
+    md5_checksum = hashlib.md5(seq.encode()).hexdigest()
+    with blaster.metrics.timer("format",md5_checksum):
+        if OUTPUT_FORMAT == "text":
+            for acc, qc, match, bp, title in blaster.summary_formatter(summary,number_of_alignments=NUMBER_OF_ALIGNMENTS,max_high_scoring_pairs=MAX_HIGH_SCORING_PAIRS):
+                custom_parsing(seq, qc, acc, match, bp, title)
+            return
+        if result_writer is None:
+            result_writer = ResultWriter(get_output_file(),OUTPUT_FORMAT,NUMBER_OF_ALIGNMENTS,MAX_HIGH_SCORING_PAIRS)
+        result_writer.write(position,seq,md5_checksum,summary)
+
+
+# How many sequences the input has, estimated from how far into the file the sequences read so far are, until all are read
+total_sequences:int|None = None
+total_known = False
+def read_sequences(file_path:str):
+    # Yields the sequences of the file while keeping total_sequences up to date, so the progress needs no extra pass over the input
+    global total_sequences, total_known
+    with blaster.open_sequence_file(file_path) as file:
+        size = os.fstat(file.fileno()).st_size
+        read = 0
+        for query_sequence in blaster.get_sequence(file):
+            read += 1
+            # The bytes taken from the file, compressed or not, run ahead of the parser by its read buffer,
+            # so there is no estimate while all of the file is in the buffer
+            position = os.lseek(file.fileno(),0,os.SEEK_CUR)
+            if 0 < position < size:
+                total_sequences = max(read,round(read*size/position))
+            yield query_sequence
+    total_sequences, total_known = read, True
+
+
+# The worker thread reports through events, which check reads on the Tk main thread, as Tk may only be used from there
+events:queue.Queue[tuple] = queue.Queue()
+# Set by the cancel button, the sequences already started are finished and the rest are left for the next run
+cancel = threading.Event()
+worker:threading.Thread|None = None
+def report(stage:str, completed:int):
+    events.put(("progress",stage,completed,total_sequences,total_known,time.time()))
+
+
+def start_job(func:Callable, done_message:str, **kwargs):
+    # Runs func in a worker thread, so the window stays responsive
+    global worker, progress, stage_start, total_sequences, total_known
+    cancel.clear()
+    progress = stage_start = total_sequences = None
+    total_known = False
+    set_running(True)
+    progress_label.config(text="Starting")
+    def run():
+        try:
+            try:
+                func(**kwargs)
+            finally:
+                close_output()
+        except Exception as e:
+            traceback.print_exc()
+            events.put(("error",f"{type(e).__name__}: {e}"))
+        else:
+            events.put(("done","Cancelled, the sequences which were started are done, run it again to continue" if cancel.is_set() else done_message))
+    worker = threading.Thread(target=run,daemon=True)
+    worker.start()
+
+
+def cancel_job():
+    print("[!] Cancelling, waiting for the sequences which were started")
+    cancel.set()
+    cancel_button.config(state=tk.DISABLED)
+    show_progress()
+
+
+def set_running(running:bool):
+    for button in (process_button,process_and_parse_button,parse_button):
+        button.config(state=tk.DISABLED if running else tk.NORMAL)
+    cancel_button.config(state=tk.NORMAL if running else tk.DISABLED)
+
+
+# The latest (stage, completed, total, total_known, time) of the worker, and (stage, time, completed) of when the stage started, for the rate
+progress:tuple[str,int,int|None,bool,float]|None = None
+stage_start:tuple[str,float,int]|None = None
+def show_progress():
+    global stage_start
+    if progress is None:
+        return
+    stage, completed, total, known, t = progress
+    if stage_start is None or stage_start[0] != stage:
+        stage_start = (stage,t,completed)
+    _, started, start_completed = stage_start
+    text = f"{stage} {completed}/{'?' if total is None else total if known else f'~{total}'}"
+    # The rate only counts the sequences of this run, skipped and cached ones are done before the clock really starts
+    elapsed = time.time()-started
+    per_minute = (completed-start_completed)/elapsed*60 if elapsed > 0 else 0
+    if per_minute > 0:
+        text += f"  {per_minute:.1f} sequences/min"
+        if total is not None:
+            text += f"  ETA {datetime.timedelta(seconds=round(max(total-completed,0)/per_minute*60))}"
+    if cancel.is_set():
+        text += "  Cancelling..."
+    progress_label.config(text=text)
+
+
+closing = False
+def on_close():
+    # A running job is cancelled and drained before the window closes
+    global closing
+    if worker is None:
+        root.destroy()
+    elif confirm("A job is running, cancel it and close when the started sequences are done?"):
+        closing = True
+        cancel_job()
 
 
 file_path = None
@@ -64,10 +196,12 @@ def get_db():
 
 
 def get_concurrent_requests(_min=1,_max=os.cpu_count()):
-    # Check if concurrent_requests is a valid integer
+    # Check if concurrent_requests is a valid integer, or auto which lets blaster pick processes and threads
     concurrent_requests = concurrent_requests_entry.get()
+    if concurrent_requests.strip().lower() == "auto":
+        return "auto"
     if not concurrent_requests or not concurrent_requests.lstrip("-").isdigit():
-        messagebox.showerror("Error", "Invalid concurrent requests. Please enter a valid integer.")
+        messagebox.showerror("Error", "Invalid concurrent requests. Please enter a valid integer or 'auto'.")
         return
 
     concurrent_requests = int(concurrent_requests)
@@ -86,29 +220,31 @@ def get_concurrent_requests(_min=1,_max=os.cpu_count()):
 # Function to handle button click
 def on_button_click(func:Callable):
     # Determine which arguments goes where
-
+    if worker is not None:
+        messagebox.showerror("Error", "A job is already running. Wait for it, or cancel it first.")
+        return
 
     if func==process:
         file_path = get_file_path()
         db = get_db()
         concurrent_requests = get_concurrent_requests()
         if file_path==None or db==None or concurrent_requests==None:return
-        process(file_path=file_path, db=db, concurrent_requests=concurrent_requests)
-        messagebox.showinfo("Done",f"Processing done, you can now parse the data or close the program")
+        if concurrent_requests=="auto":concurrent_requests = None
+        start_job(process,f"Processing done, you can now parse the data or close the program",file_path=file_path, db=db, concurrent_requests=concurrent_requests)
 
     elif func==process_and_parse:
         file_path = get_file_path()
         db = get_db()
         concurrent_requests = get_concurrent_requests()
         if file_path==None or db==None or concurrent_requests==None:return
-        process_and_parse(file_path=file_path, db=db, concurrent_requests=concurrent_requests)
-        messagebox.showinfo("Done",f"Proccessing and parsing done, you can find the data in {output_file_name}")
+        if concurrent_requests=="auto":concurrent_requests = None
+        start_job(process_and_parse,f"Proccessing and parsing done, you can find the data in {output_file_name}",file_path=file_path, db=db, concurrent_requests=concurrent_requests)
     
     elif func==parse:
         file_path = get_file_path()
-        if file_path==None:return
-        parse(file_path=file_path)
-        messagebox.showinfo("Done",f"Parsing done, you can find the data in {output_file_name}")
+        db = get_db()
+        if file_path==None or db==None:return
+        start_job(parse,f"Parsing done, you can find the data in {output_file_name}",file_path=file_path, db=db)
     else:
         func()
 
@@ -132,56 +268,106 @@ def open_file_dialog():
 
 # create output file
 current_time = datetime.datetime.now()
-output_file_name = f"{current_time.year:02d}_{current_time.month:02d}_{current_time.day:02d}_{current_time.hour:02d}_{current_time.minute:02d}_{current_time.second:02d}.txt"
-def write(*values,sep=" ",end="\n"):
-    with open(output_file_name,"a") as f:
-        f.write(sep.join(map(str,values))+end)
-
-# Create the main application window
-root = tk.Tk()
-root.title("Blaster")
-icon_path = "icon.png"
-icon = tk.PhotoImage(file=icon_path)
-
-# Set window icon
-assert hasattr(root,"_w")
-root.tk.call('wm', 'iconphoto', getattr(root,"_w"), icon)
+output_file_name = f"{current_time.year:02d}_{current_time.month:02d}_{current_time.day:02d}_{current_time.hour:02d}_{current_time.minute:02d}_{current_time.second:02d}.{'txt' if OUTPUT_FORMAT == 'text' else OUTPUT_FORMAT}"
+# The output file is kept open with a large buffer while a job runs, instead of being opened for every line
+OUTPUT_BUFFER_SIZE = 1<<20
+output_file = None
+result_writer:ResultWriter|None = None
+def get_output_file():
+    global output_file
+    if output_file is None:
+        output_file = open(output_file_name,"a",buffering=OUTPUT_BUFFER_SIZE)
+    return output_file
+
+def close_output():
+    global output_file, result_writer
+    if output_file is not None:
+        output_file.close()
+    output_file = result_writer = None
 
-# Create and pack widgets
-file_path_label = tk.Label(root, text="Input File:")
-file_path_label.pack()
-
-file_dialog_button = tk.Button(root, text="Open File", command=open_file_dialog)
-file_dialog_button.pack()
-
-db_label = tk.Label(root, text="DB:")
-db_label.pack()
-
-db_entry = tk.Entry(root)
-db_entry.pack()
-
-concurrent_requests_label = tk.Label(root, text="Concurrent Requests:")
-concurrent_requests_label.pack()
-
-concurrent_requests_entry = tk.Entry(root)
-concurrent_requests_entry.pack()
-
-button_text = tk.StringVar()
-
-process_button = tk.Button(root, text="Process", command=lambda: on_button_click(func=process))
-process_button.pack()
-
-process_and_parse_button = tk.Button(root, text="Process & Parse", command=lambda: on_button_click(func=process_and_parse))
-process_and_parse_button.pack()
-
-parse_button = tk.Button(root, text="Parse", command=lambda: on_button_click(func=parse))
-parse_button.pack()
-
-def check():
-    root.after(1000, check)
-check()
-
-try:
-    root.mainloop()
-except KeyboardInterrupt:
-    exit("\r[-] Program stopped")
\ No newline at end of file
+def write(*values,sep=" ",end="\n"):
+    get_output_file().write(sep.join(map(str,values))+end)
+
+# The window is only created when run as a script, as the processes parsing the results import this file again on
+# platforms which spawn them, like Windows and macOS
+if __name__ == "__main__":
+    blaster.metrics.configure(METRICS_LOG,METRICS_FILE)
+
+    # Create the main application window
+    root = tk.Tk()
+    root.title("Blaster")
+    icon_path = "icon.png"
+    icon = tk.PhotoImage(file=icon_path)
+
+    # Set window icon
+    assert hasattr(root,"_w")
+    root.tk.call('wm', 'iconphoto', getattr(root,"_w"), icon)
+
+    # Create and pack widgets
+    file_path_label = tk.Label(root, text="Input File:")
+    file_path_label.pack()
+
+    file_dialog_button = tk.Button(root, text="Open File", command=open_file_dialog)
+    file_dialog_button.pack()
+
+    db_label = tk.Label(root, text="DB:")
+    db_label.pack()
+
+    db_entry = tk.Entry(root)
+    db_entry.pack()
+
+    concurrent_requests_label = tk.Label(root, text="Concurrent Requests:")
+    concurrent_requests_label.pack()
+
+    concurrent_requests_entry = tk.Entry(root)
+    concurrent_requests_entry.pack()
+
+    button_text = tk.StringVar()
+
+    process_button = tk.Button(root, text="Process", command=lambda: on_button_click(func=process))
+    process_button.pack()
+
+    process_and_parse_button = tk.Button(root, text="Process & Parse", command=lambda: on_button_click(func=process_and_parse))
+    process_and_parse_button.pack()
+
+    parse_button = tk.Button(root, text="Parse", command=lambda: on_button_click(func=parse))
+    parse_button.pack()
+
+    cancel_button = tk.Button(root, text="Cancel", command=cancel_job, state=tk.DISABLED)
+    cancel_button.pack()
+
+    progress_label = tk.Label(root, text="")
+    progress_label.pack()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
+
+    def check():
+        # Handles what the worker reported since the last check
+        global worker, progress
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "progress":
+                progress = event[1:]
+                continue
+            worker = None
+            set_running(False)
+            show_progress()
+            if closing:
+                root.destroy()
+                return
+            if event[0] == "done":
+                messagebox.showinfo("Done",event[1])
+            else:
+                messagebox.showerror("Error",event[1])
+        if worker is not None:
+            show_progress()
+        root.after(1000, check)
+    check()
+
+    try:
+        root.mainloop()
+    except KeyboardInterrupt:
+        exit("\r[-] Program stopped")
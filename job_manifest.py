@@ -0,0 +1,111 @@
+from typing import Iterable
+import threading
+import sqlite3
+import hashlib
+import time
+import re
+
+from cache_store import SearchParams
+
+QUEUED = "queued"
+SUBMITTED = "submitted"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobManifest:
+    # The state of every sequence of a run, queued, submitted, done or failed, kept in a sqlite file
+    # Sequences are identified by their position in the input, so an interrupted run can skip the finished ones without hashing them,
+    # and remote searches keep their RID, so they are polled again instead of being submitted again
+    def __init__(self, path:str, params:SearchParams):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path,timeout=60,check_same_thread=False,isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS params (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                position INTEGER PRIMARY KEY,
+                checksum TEXT NOT NULL,
+                length INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                search TEXT,
+                error TEXT,
+                updated REAL NOT NULL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_checksum ON jobs (checksum)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_search ON jobs (search)")
+        # The query of each remote search, so it can be submitted again if its RID has expired
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS searches (
+                search TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                rid TEXT,
+                created REAL NOT NULL
+            )""")
+        # A manifest belongs to a single set of search parameters
+        stored = dict(self.execute("SELECT key,value FROM params"))
+        for key,value in params._asdict().items():
+            if key in stored and stored[key] != str(value):
+                raise ValueError(f"Manifest '{path}' was made with {key}={stored[key]}, not {key}={value}")
+            self.execute("INSERT OR IGNORE INTO params (key,value) VALUES (?,?)",(key,str(value)))
+
+    def execute(self, sql:str, parameters:tuple=()):
+        with self.lock:
+            return self.connection.execute(sql,parameters).fetchall()
+
+    def pending(self, query_sequences:Iterable, skip_done=True):
+        # Yields the sequences which aren't done yet, and queues them, skip_done=False also yields the done ones, which are left as they are
+        # A finished position is only checked against the length of the sequence, so the input must not change between runs
+        done = dict(self.execute("SELECT position,length FROM jobs WHERE state=?",(DONE,)))
+        skipped = 0
+        for position,query_sequence in enumerate(query_sequences):
+            if done.get(position) == len(query_sequence):
+                skipped += 1
+                if not skip_done:
+                    yield query_sequence
+                continue
+            md5_checksum = hashlib.md5(str(query_sequence).encode()).hexdigest()
+            # A submitted search is kept, so its RID can be polled again
+            self.execute("""
+                INSERT INTO jobs (position,checksum,length,state,updated) VALUES (?,?,?,?,?)
+                ON CONFLICT (position) DO UPDATE SET
+                    state=CASE WHEN jobs.state=? AND jobs.checksum=excluded.checksum THEN jobs.state ELSE excluded.state END,
+                    search=CASE WHEN jobs.state=? AND jobs.checksum=excluded.checksum THEN jobs.search END,
+                    checksum=excluded.checksum, length=excluded.length, error=NULL, updated=excluded.updated""",
+                (position,md5_checksum,len(query_sequence),QUEUED,time.time(),SUBMITTED,SUBMITTED))
+            yield query_sequence
+        if skipped != 0:
+            print(f"[.] {'Skipped' if skip_done else 'Reading from the cache'} {skipped} sequences which were done in an earlier run")
+
+    def add_search(self, search:str, query:str):
+        # Records the query of a remote search, before it is submitted
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO searches (search,query,created) VALUES (?,?,?)",(search,query,time.time()))
+            checksums = re.findall(r">(\S+)",query)
+            self.connection.execute(f"UPDATE jobs SET search=? WHERE state!=? AND checksum IN ({','.join('?'*len(checksums))})",(search,DONE,*checksums))
+
+    def submitted(self, search:str, rid:str):
+        # Records the RID of a remote search, once it has been submitted
+        with self.lock:
+            self.connection.execute("UPDATE searches SET rid=? WHERE search=?",(rid,search))
+            self.connection.execute("UPDATE jobs SET state=?, updated=? WHERE search=? AND state!=?",(SUBMITTED,time.time(),search,DONE))
+
+    def outstanding(self):
+        # Returns (search, query, rid) of the remote searches which were submitted but never finished
+        return self.execute("""
+            SELECT search,query,rid FROM searches WHERE rid IS NOT NULL
+            AND search IN (SELECT search FROM jobs WHERE state=?)""",(SUBMITTED,))
+
+    def finish(self, checksum:str, error:str|None=None):
+        # Marks every position of the sequence as done, or as failed with the error
+        with self.lock:
+            self.connection.execute("UPDATE jobs SET state=?, error=?, updated=? WHERE checksum=?",(DONE if error is None else FAILED,error,time.time(),checksum))
+            # Searches are only kept while some of their sequences are outstanding
+            self.connection.execute("""
+                DELETE FROM searches WHERE search IN (SELECT search FROM jobs WHERE checksum=?)
+                AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.search=searches.search AND jobs.state!=?)""",(checksum,DONE))
+
+    def counts(self):
+        # Returns the number of sequences in each state
+        return dict(self.execute("SELECT state,count(*) FROM jobs GROUP BY state"))
@@ -0,0 +1,126 @@
+from typing import Any
+import http.server
+import contextlib
+import threading
+import bisect
+import json
+import time
+import os
+
+# Upper bounds in seconds of the histogram buckets of the stage timings
+BUCKETS = (0.001,0.005,0.01,0.05,0.1,0.5,1,5,10,30,60,300,600,1800,3600,float("inf"))
+# The Prometheus file is written at most this often, in seconds
+WRITE_INTERVAL = 5
+
+
+class Metrics:
+    # Per sequence timings of each stage of the pipeline, and counters of the batches
+    # The timings are aggregated into histograms, and if a log is configured, every timing is also a line of JSON in it
+    # The aggregates are exported in the Prometheus text format, to a file and/or over HTTP
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.log = None
+        self.prometheus_path:str|None = None
+        self.last_write = 0.0
+        self.server:http.server.ThreadingHTTPServer|None = None
+        self.histograms:dict[str,list[float]] = dict()
+        self.sums:dict[str,float] = dict()
+        self.counters:dict[tuple[str,tuple[tuple[str,str],...]],float] = dict()
+
+    def configure(self, log_path:str|None=None, prometheus_path:str|None=None, port:int|None=None):
+        # log_path is appended with a JSON line per timing, prometheus_path is rewritten with the aggregates,
+        # and port serves the aggregates at http://localhost:port/metrics
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+            self.log = open(log_path,"a",buffering=1) if log_path is not None else None
+            self.prometheus_path = prometheus_path
+        if port is not None and self.server is None:
+            self.serve(port)
+
+    def record(self, stage:str, key:str, seconds:float, **fields:Any):
+        # Records that stage took seconds for the sequence or search with key
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = [0]*len(BUCKETS)
+                self.sums[stage] = 0.0
+            self.histograms[stage][bisect.bisect_left(BUCKETS,seconds)] += 1
+            self.sums[stage] += seconds
+            if self.log is not None:
+                self.log.write(json.dumps({"time":time.time(),"stage":stage,"key":key,"seconds":seconds,**fields})+"\n")
+        self.write_if_due()
+
+    @contextlib.contextmanager
+    def timer(self, stage:str, key:str, **fields:Any):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage,key,time.perf_counter()-t,**fields)
+
+    def count(self, name:str, value:float=1, **labels:str):
+        # Adds value to the counter name with the labels
+        key = (name,tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key,0)+value
+        self.write_if_due()
+
+    def prometheus(self):
+        # Returns the aggregates in the Prometheus text format
+        with self.lock:
+            lines = []
+            if len(self.histograms) != 0:
+                lines.append("# HELP blaster_stage_seconds Seconds spent per sequence or search in each stage")
+                lines.append("# TYPE blaster_stage_seconds histogram")
+            for stage,buckets in sorted(self.histograms.items()):
+                total = 0
+                for bound,count in zip(BUCKETS,buckets):
+                    total += count
+                    lines.append(f'blaster_stage_seconds_bucket{{stage="{stage}",le="{"+Inf" if bound == float("inf") else bound}"}} {total}')
+                lines.append(f'blaster_stage_seconds_sum{{stage="{stage}"}} {self.sums[stage]}')
+                lines.append(f'blaster_stage_seconds_count{{stage="{stage}"}} {total}')
+            for name in sorted({name for name,_ in self.counters}):
+                lines.append(f"# TYPE blaster_{name} counter")
+                for (counter_name,labels),value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        label_text = ",".join(f'{label}="{label_value}"' for label,label_value in labels)
+                        lines.append(f"blaster_{name}{{{label_text}}} {value}" if label_text else f"blaster_{name} {value}")
+        return "\n".join(lines)+"\n"
+
+    def write_if_due(self):
+        if self.prometheus_path is not None and time.monotonic()-self.last_write > WRITE_INTERVAL:
+            self.write()
+
+    def write(self):
+        # Writes the aggregates to the Prometheus file, through a temporary file so it is never read half written
+        if self.prometheus_path is None:
+            return
+        self.last_write = time.monotonic()
+        temporary_path = f"{self.prometheus_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path,"w") as f:
+            f.write(self.prometheus())
+        os.replace(temporary_path,self.prometheus_path)
+
+    def serve(self, port:int):
+        # Serves the aggregates at /metrics from a background thread
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type","text/plain; version=0.0.4")
+                self.send_header("Content-Length",str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+        self.server = http.server.ThreadingHTTPServer(("",port),Handler)
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        print(f"[.] Serving metrics at http://localhost:{self.server.server_address[1]}/metrics")
+
+
+# The metrics of this process
+metrics = Metrics()
@@ -1,34 +1,177 @@
-from typing import Any
-import urllib.request
+from typing import Any,Callable
+import concurrent.futures
+import urllib.error
+import urllib.parse
+import http.client
+import threading
 import tarfile
 import hashlib
+import shutil
 import ctypes
+import random
 import time
 import json
+import io
 import re
 import os
 
+import db_versions
+
 BASE_URL = 'https://ftp.ncbi.nlm.nih.gov/blast/db/'
 REMOTE_DB_CACHE_FNAME = "remote_db_cache.json"
-USE_FTP = True
+# The remote dbs are fetched again when listed, once the cache is older than this many seconds
+REMOTE_DB_CACHE_TTL = 24*60*60
+# Number of metadata files fetched at the same time
+CATALOG_WORKERS = 8
+# Number of volumes downloaded at the same time
+DOWNLOAD_WORKERS = 4
+# Failed requests are retried this many times, waiting DOWNLOAD_BACKOFF seconds doubled each time, at most DOWNLOAD_MAX_BACKOFF
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 2
+DOWNLOAD_MAX_BACKOFF = 120
+CHUNK_SIZE = 1024**2
+# Volumes are extracted into a folder with this prefix, and only moved into the db once their hash matches
+STAGING_PREFIX = ".staging."
+
+# Each thread keeps its own connection to each host, so consecutive downloads skip the connection setup
+connections = threading.local()
 
-def download_from_url(url,fname,retries=2):
-    def report_hook(packet_number,packet_size,total_size):
-        print(f"[.] {packet_number*packet_size/total_size*100:0.2f}%",end="\r")
-    if retries<0:return False
+def open_url(url:str, headers:dict[str,str]|None=None, redirects:int=5):
+    # Sends a GET request on the pooled connection of this thread
+    url = http_url(url)
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http","https"):
+        raise ValueError(f"Can't download '{url}', only http and https urls are supported")
+    if not hasattr(connections,"pool"):connections.pool = dict()
+    pool:dict[tuple[str,str],http.client.HTTPConnection] = connections.pool
+    connection = pool.get((parts.scheme,parts.netloc))
+    reused = connection is not None
+    if connection is None:
+        connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        connection = pool[(parts.scheme,parts.netloc)] = connection_class(parts.netloc,timeout=60)
     try:
-        return urllib.request.urlretrieve(url,fname,reporthook=report_hook)
-    except KeyboardInterrupt:
-        exit("[!] Recieved KeyboardInterrupt")
-    except:
-        print(f"[!] Retrying the download. {retries} retries left")
-        return download_from_url(url,fname,retries-1)
-
-def fetch_metadata(metadata_url:str):
-    # Fetch metadata of the db
-    download_from_url(metadata_url,"tmpfile")
-    metadata:dict[str,Any] = json.load(open("tmpfile"))
-        
+        connection.request("GET",(parts.path or "/")+("?"+parts.query if parts.query else ""),headers=headers or {})
+        response = connection.getresponse()
+    except (OSError,http.client.HTTPException):
+        close_connection(url)
+        if reused:
+            # The server closed the idle connection, so try again on a new one
+            return open_url(url,headers,redirects)
+        raise
+    if response.status in (301,302,303,307,308) and redirects > 0:
+        response.read()
+        return open_url(urllib.parse.urljoin(url,response.getheader("Location","")),headers,redirects-1)
+    return response
+
+def http_url(url:str):
+    # The metadata lists ftp urls, which NCBI serves on the same paths over https, where Range requests work
+    return "https://"+url[len("ftp://"):] if url.startswith("ftp://") else url
+
+def close_connection(url:str):
+    # Closes the pooled connection of this thread, after a response which wasn't read to the end
+    parts = urllib.parse.urlsplit(http_url(url))
+    connection = getattr(connections,"pool",dict()).pop((parts.scheme,parts.netloc),None)
+    if connection is not None:
+        connection.close()
+
+def with_retries(func:Callable, description:str, retries:int=DOWNLOAD_RETRIES):
+    # Calls func until it doesn't fail, waiting longer after each failure
+    for attempt in range(retries+1):
+        try:
+            return func()
+        except (OSError,http.client.HTTPException) as e:
+            # Requests for missing files are not retried
+            if attempt == retries or (isinstance(e,urllib.error.HTTPError) and 400 <= e.code < 500 and e.code not in (408,429)):
+                raise
+            delay = min(DOWNLOAD_MAX_BACKOFF,DOWNLOAD_BACKOFF*2**attempt)*random.uniform(0.5,1)
+            print(f"[!] {description} failed with `{e}`, retrying in {delay:0.0f} seconds. {retries-attempt} retries left")
+            time.sleep(delay)
+
+def fetch(url:str, retries:int=DOWNLOAD_RETRIES):
+    # Returns the content of a small file
+    def attempt():
+        response = open_url(url)
+        data = response.read()
+        if response.status != 200:
+            raise urllib.error.HTTPError(url,response.status,response.reason,response.headers,None)
+        return data
+    return with_retries(attempt,f"Fetching '{url}'",retries)
+
+def fetch_if_changed(url:str, etag:str|None=None, last_modified:str|None=None, retries:int=DOWNLOAD_RETRIES):
+    # Returns (content, etag, last_modified) of a small file, content is None if it hasn't changed since etag and last_modified
+    headers = dict()
+    if etag is not None:headers["If-None-Match"] = etag
+    if last_modified is not None:headers["If-Modified-Since"] = last_modified
+    def attempt():
+        response = open_url(url,headers)
+        data = response.read()
+        if response.status == 304:
+            return None, etag, last_modified
+        if response.status != 200:
+            raise urllib.error.HTTPError(url,response.status,response.reason,response.headers,None)
+        return data, response.getheader("ETag"), response.getheader("Last-Modified")
+    return with_retries(attempt,f"Fetching '{url}'",retries)
+
+class DownloadStream(io.RawIOBase):
+    # Reads a download as a stream while hashing it, so the file never has to be written to disk
+    # A broken connection is resumed with an HTTP Range request from the bytes already read
+    def __init__(self, url:str, fname:str, report:Callable[[str,int,int|None],None]|None=None, retries:int=DOWNLOAD_RETRIES):
+        self.url = url
+        self.fname = fname
+        self.report = report
+        self.retries = retries
+        self.checksum = hashlib.md5()
+        self.offset = 0
+        self.total:int|None = None
+        self.response:http.client.HTTPResponse|None = None
+
+    def readable(self):
+        return True
+
+    def open(self):
+        response = open_url(self.url,{"Range":f"bytes={self.offset}-"} if self.offset != 0 else None)
+        if response.status not in (200,206):
+            response.read()
+            raise urllib.error.HTTPError(self.url,response.status,response.reason,response.headers,None)
+        length = response.getheader("Content-Length")
+        self.total = (self.offset if response.status == 206 else 0)+int(length) if length is not None else None
+        skip = self.offset if response.status == 200 else 0
+        # The server ignored the range, so the bytes already read are skipped
+        while skip > 0:
+            data = response.read(min(skip,CHUNK_SIZE))
+            if len(data) == 0:
+                raise ConnectionError(f"Connection closed after {self.offset-skip} of {self.offset} skipped bytes")
+            skip -= len(data)
+        return response
+
+    def readinto(self, buffer):
+        def attempt():
+            try:
+                if self.response is None:
+                    self.response = self.open()
+                data = self.response.read(len(buffer))
+                if len(data) == 0 and self.total is not None and self.offset < self.total:
+                    raise ConnectionError(f"Connection closed after {self.offset} of {self.total} bytes")
+                return data
+            except BaseException:
+                self.response = None
+                close_connection(self.url)
+                raise
+        data = with_retries(attempt,f"Downloading '{self.fname}'",self.retries)
+        self.checksum.update(data)
+        self.offset += len(data)
+        if self.report is not None:self.report(self.fname,self.offset,self.total)
+        buffer[:len(data)] = data
+        return len(data)
+
+def fetch_metadata(metadata_url:str, previous:dict[str,Any]|None=None):
+    # Fetch metadata of the db, previous is the db fetched last time, which is returned as is if the metadata hasn't changed
+    if previous is not None and previous.get('url') != metadata_url:previous = None
+    data, etag, last_modified = fetch_if_changed(metadata_url,*((previous.get('etag'),previous.get('last_modified')) if previous is not None else ()))
+    if data is None:
+        return previous
+    metadata:dict[str,Any] = json.loads(data)
+
     # Make sure metadata version is supported
     metadata_version = float(metadata["version"])
     supported_version = (1.1,)
@@ -40,43 +183,117 @@ def fetch_metadata(metadata_url:str):
         db['name'] = metadata["dbname"]
         db['files'] = metadata["files"]
         db['size'] = metadata["bytes-total"]
+    # Kept to only fetch the metadata again once it has changed
+    db['url'] = metadata_url
+    db['etag'] = etag
+    db['last_modified'] = last_modified
     return db
 
-def update_db(db):
-    # Install a db by its metadata entries
+def update_db(db, workers:int=DOWNLOAD_WORKERS):
+    # Install a db by its metadata entries, several volumes are downloaded at the same time
+    # The update is built as a new version next to the current one, which is only switched to once every volume is in place
     print(f"[.] Installing {db['name']}")
-    if not os.path.exists(db['name']):os.mkdir(db['name'])
-    for file_url in db['files']:
-        if not USE_FTP:file_url = file_url.replace("ftp://","https://")
-        md5_url = file_url+".md5"
-        md5_fname = db['name']+"/"+md5_url.rsplit("/")[-1]
-        file_fname = db['name']+"/"+file_url.rsplit("/")[-1]
-
-        print(f"[.] Downloading hash of '{file_fname}'")
-        download_from_url(md5_url, "tmpfile")
-        if os.path.exists(md5_fname) and open("tmpfile").read().strip()==open(md5_fname).read().strip():
-            print(f"[.] Hashes match, '{file_fname}' is already up-to-date")
-            continue
-
-        print(f"[.] Downloading '{file_fname}'")
-        download_from_url(file_url, file_fname,)
+    building = db_versions.building_folder(db['name'])
+    current = db_versions.current_version(db['name']) or (db['name'] if os.path.isdir(db['name']) else None)
+    lock = threading.Lock()
+    received:dict[str,int] = dict()
+    last_report = [0.0]
+    def report(fname,size,total):
+        with lock:
+            received[fname] = size
+            if time.monotonic()-last_report[0] > 1:
+                last_report[0] = time.monotonic()
+                print(f"[.] {sum(received.values())/1024**3:0.2f} GB downloaded",end="\r")
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(update_volume,db,file_url,building,current,report):file_url for file_url in db['files']}
+        changed = 0
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                changed += future.result()
+            except (OSError,http.client.HTTPException,AssertionError,tarfile.TarError) as e:
+                print(f"[!] Failed to update '{futures[future]}', `{e}`")
+                failed.append(futures[future])
+    if len(failed) != 0:
+        print(f"[!] {len(failed)} of {len(db['files'])} files failed, run the update again to retry them")
+        return False
+    if changed == 0 and current is not None:
+        print(f"[.] '{db['name']}' is already up-to-date")
+        shutil.rmtree(building)
+        return True
+    db_versions.activate(db['name'],building)
+    db_versions.remove_old_versions(db['name'])
+    return True
+
+def update_volume(db, file_url:str, target:str, current:str|None=None, report:Callable[[str,int,int|None],None]|None=None):
+    # Puts a single volume of a db into the target folder, and returns whether it changed from the current version
+    # An unchanged volume is linked from the current version, a changed one is downloaded, checked and extracted
+    md5_url = file_url+".md5"
+    md5_fname = target+"/"+md5_url.rsplit("/")[-1]
+    files_fname = target+"/"+file_url.rsplit("/")[-1]+".files"
+    file_fname = db['name']+"/"+file_url.rsplit("/")[-1]
+
+    print(f"[.] Downloading hash of '{file_fname}'")
+    md5 = fetch(md5_url).decode().strip()
+    if os.path.exists(md5_fname) and md5==open(md5_fname).read().strip():
+        print(f"[.] Hashes match, '{file_fname}' is already in the new version")
+        return current is None or not same_volume(md5,md5_fname,current)
+    if current is not None and same_volume(md5,md5_fname,current) and os.path.exists(os.path.join(current,os.path.basename(files_fname))):
+        print(f"[.] Hashes match, '{file_fname}' is already up-to-date")
+        with open(os.path.join(current,os.path.basename(files_fname))) as f:
+            fnames = f.read().splitlines()
+        for fname in fnames:
+            link_file(os.path.join(current,fname),os.path.join(target,fname))
+        link_file(os.path.join(current,os.path.basename(files_fname)),files_fname)
+        with open(md5_fname,"w") as f:
+            f.write(md5)
+        return False
+
+    # The volume is hashed and extracted while it downloads, into a staging folder which is only moved into the db if the hash matches
+    staging_folder = target+"/"+STAGING_PREFIX+file_url.rsplit("/")[-1]
+    if os.path.exists(staging_folder):shutil.rmtree(staging_folder)
+    try:
+        print(f"[.] Downloading and extracting '{file_fname}'")
+        stream = io.BufferedReader(DownloadStream(file_url,file_fname,report),CHUNK_SIZE)
+        with tarfile.open(fileobj=stream,mode="r|*") as f:
+            f.extractall(staging_folder)
+        # The hash covers the padding after the end of the archive too
+        while len(stream.read(CHUNK_SIZE)) != 0:pass
 
         print(f"[.] Comparing hash of '{file_fname}'")
-        with open(file_fname,'rb') as f:
-            checksum = hashlib.md5()
-            while True:
-                data = f.read(1024**2)
-                if len(data) == 0:break
-                checksum.update(data)
-        assert open("tmpfile").read().strip().startswith(checksum.hexdigest()),"Hashes don't match?"
-        os.rename("tmpfile",md5_fname)
-
-        print(f"[.] Extracting '{file_fname}'")
-        with tarfile.open(file_fname) as f:
-            f.extractall(db['name']) 
-
-        print(f"[.] Removing '{file_fname}'")
-        os.remove(file_fname)
+        if not md5.startswith(stream.raw.checksum.hexdigest()):
+            raise AssertionError(f"Hashes of '{file_fname}' don't match?")
+
+        extracted = []
+        for folder_path,_,fnames in os.walk(staging_folder):
+            target_folder = os.path.join(target,os.path.relpath(folder_path,staging_folder))
+            if not os.path.exists(target_folder):os.makedirs(target_folder)
+            for fname in fnames:
+                os.replace(os.path.join(folder_path,fname),os.path.join(target_folder,fname))
+                extracted.append(os.path.relpath(os.path.join(target_folder,fname),target))
+        # The files of the volume, so the next version can link them if the volume doesn't change
+        with open(files_fname,"w") as f:
+            f.write("\n".join(extracted))
+        with open(md5_fname,"w") as f:
+            f.write(md5)
+    finally:
+        shutil.rmtree(staging_folder,ignore_errors=True)
+    return True
+
+def same_volume(md5:str, md5_fname:str, current:str):
+    # Whether the current version has the volume with the md5
+    current_md5_fname = os.path.join(current,os.path.basename(md5_fname))
+    return os.path.exists(current_md5_fname) and md5==open(current_md5_fname).read().strip()
+
+def link_file(source:str, destination:str):
+    # Hard links the file into the new version, so unchanged volumes take no extra space, and copies it where links aren't possible
+    if os.path.exists(destination):return
+    if not os.path.exists(os.path.dirname(destination)):os.makedirs(os.path.dirname(destination),exist_ok=True)
+    try:
+        os.link(source,destination)
+    except OSError:
+        shutil.copy2(source,destination)
 
 def get_local_dbs():
     # Fetch the local dbs
@@ -109,23 +326,29 @@ def save_remote_dbs(remote_db):
     with open(REMOTE_DB_CACHE_FNAME,"w") as f:
         json.dump(remote_db,f)
 
-def fetch_remote_dbs(remote_dbs):
+def remote_dbs_expired():
+    # Whether the cache of remote dbs is missing or older than REMOTE_DB_CACHE_TTL
+    if not os.path.exists(REMOTE_DB_CACHE_FNAME):return True
+    return time.time()-os.path.getmtime(REMOTE_DB_CACHE_FNAME) > REMOTE_DB_CACHE_TTL
+
+def fetch_remote_dbs(remote_dbs, workers:int=CATALOG_WORKERS):
     # Fetch remote names
     print("[.] Fetching remote dbs")
-    download_from_url(BASE_URL, "tmpfile")
     pattern = r'"([^"]+metadata\.json)"'
-    file_list = open("tmpfile").read()
+    file_list = fetch(BASE_URL).decode()
     metadata_names = re.findall(pattern,file_list)
 
-    # Clear remote dbs
-    for db_name in remote_dbs:
-        del remote_dbs[db_name]
+    # Fetch remote dbs, the metadata which hasn't changed since the last fetch is reused
+    previous_dbs = {db.get('url'):db for db in remote_dbs.values()}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        metadata_urls = [BASE_URL.rstrip("/")+"/"+metadata_name.lstrip("/") for metadata_name in metadata_names]
+        dbs = list(executor.map(lambda metadata_url: fetch_metadata(metadata_url,previous_dbs.get(metadata_url)),metadata_urls))
+    changed = sum(db is not previous_dbs.get(db['url']) for db in dbs)
+    print(f"[.] Fetched {len(dbs)} remote dbs, {changed} of them changed")
 
-    # Fetch remote dbs
-    for metadata_name in metadata_names:
-        metadata_url = BASE_URL.rstrip("/")+"/"+metadata_name.lstrip("/")
-        print(f"[.] Fetching '{metadata_name}' from {metadata_url}")
-        db = fetch_metadata(metadata_url)
+    # Replace remote dbs
+    remote_dbs.clear()
+    for db in dbs:
         remote_dbs[db['name']] = db
 
     # Save remote db for loader
@@ -133,7 +356,7 @@ def fetch_remote_dbs(remote_dbs):
 
 def list_remote_dbs(remote_dbs):
     # Prints the cached remote dbs in a nice way
-    if len(remote_dbs)==0:fetch_remote_dbs(remote_dbs)
+    if len(remote_dbs)==0 or remote_dbs_expired():fetch_remote_dbs(remote_dbs)
     modification_time = os.path.getmtime(REMOTE_DB_CACHE_FNAME)
     local_dbs = get_local_dbs()    
     print(f"\33[2K\n[.] Listing remote dbs. Latest fetch '{time.ctime(modification_time)}'")
@@ -0,0 +1,391 @@
+from typing import AsyncIterator,Callable,Iterable
+import urllib.parse
+import threading
+import asyncio
+import random
+import queue
+import time
+import ssl
+import re
+
+from Bio.Blast import NCBIWWW
+
+from cache_store import SearchParams
+from metrics import metrics
+
+BLAST_URL = NCBIWWW.NCBI_BLAST_URL
+# NCBI asks for no more than one submission every 10 seconds, and no more than one poll per RID every minute
+SUBMIT_INTERVAL = 10
+POLL_INTERVAL = 60
+# Status polls of all RIDs together, per second
+POLL_RATE = 5
+# Bounds of the adaptive number of outstanding searches
+MIN_OUTSTANDING = 1
+MAX_OUTSTANDING = 200
+# Retries of a request which failed or was throttled, each waiting twice as long as the last
+RETRIES = 6
+BACKOFF = 5
+MAX_BACKOFF = 600
+THROTTLED_STATUSES = (429,500,502,503,504)
+# Results stream holds at most this many results the consumer hasn't taken yet, before it stops reading the queries
+STREAM_BUFFER = 100
+
+
+class Throttled(Exception):
+    # The service is busy, or the request failed in a way where retrying later may help
+    pass
+
+
+class TokenBucket:
+    # Allows rate requests per second, with bursts of up to capacity requests
+    def __init__(self, rate:float, capacity:float=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token, and returns how many seconds to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,self.tokens+(now-self.updated)*self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens/self.rate
+
+    async def acquire(self):
+        await asyncio.sleep(self.reserve())
+
+    def acquire_blocking(self):
+        time.sleep(self.reserve())
+
+
+def backoff_delays(retries:int=RETRIES, base:float=BACKOFF, maximum:float=MAX_BACKOFF):
+    # Exponential backoff with jitter, so throttled clients don't retry in lockstep
+    for attempt in range(retries):
+        yield min(maximum,base*2**attempt)*random.uniform(0.5,1)
+
+
+def with_backoff(func:Callable, retries:int=RETRIES, base:float=BACKOFF):
+    # Calls func, retrying with exponential backoff if it raises
+    for delay in backoff_delays(retries,base):
+        try:
+            return func()
+        except (KeyboardInterrupt,TypeError):
+            raise
+        except Exception as e:
+            print(f"[!] Remote request failed with `{e}`, retrying in {delay:0.0f} seconds")
+            time.sleep(delay)
+    return func()
+
+
+class AdaptiveLimit:
+    # Additive increase, multiplicative decrease of the number of outstanding searches
+    # The limit grows while requests are about as fast as the fastest seen lately, and shrinks when they slow down or are throttled
+    def __init__(self, initial:float, minimum:float=MIN_OUTSTANDING, maximum:float=MAX_OUTSTANDING, tolerance:float=2):
+        self.value = max(minimum,min(maximum,initial))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.latency:float|None = None
+        self.fastest:float|None = None
+        self.last_decrease = 0.0
+
+    def __int__(self):
+        return int(self.value)
+
+    def observe(self, latency:float):
+        self.latency = latency if self.latency is None else 0.8*self.latency+0.2*latency
+        # The baseline slowly drifts up, so a single lucky fast response doesn't count forever
+        self.fastest = self.latency if self.fastest is None else min(self.fastest*1.01,self.latency)
+        if self.latency > self.tolerance*self.fastest:
+            self.decrease(0.9)
+        else:
+            self.value = min(self.maximum,self.value+1/self.value)
+
+    def decrease(self, factor:float=0.5):
+        # Only decrease once per second, a burst of slow responses is a single signal
+        if time.monotonic()-self.last_decrease < 1:
+            return
+        self.last_decrease = time.monotonic()
+        self.value = max(self.minimum,self.value*factor)
+        print(f"[.] Lowering the number of outstanding searches to {int(self.value)}")
+
+
+class HttpSession:
+    # A minimal HTTP/1.1 client, which keeps a pool of open connections per host
+    def __init__(self, connections:int=4, timeout:float=300):
+        self.connections = asyncio.Semaphore(connections)
+        self.timeout = timeout
+        self.idle:dict[tuple[str,str,int],list[tuple[asyncio.StreamReader,asyncio.StreamWriter]]] = dict()
+
+    async def request(self, method:str, url:str, data:dict|None=None):
+        # Returns the status, headers and body of the response
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or "http"
+        host = parts.hostname or "localhost"
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        body = urllib.parse.urlencode(data).encode() if data is not None else b""
+        request = (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            f"User-Agent: NCBIBlaster\r\n"
+            f"Connection: keep-alive\r\n"
+            f"Content-Type: application/x-www-form-urlencoded\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        ).encode() + body
+
+        async with self.connections:
+            # An idle connection may have been closed by the server, so retry once on a new connection
+            for reused in (True, False):
+                connection = self.idle.get((scheme,host,port),[]).pop() if reused and self.idle.get((scheme,host,port)) else None
+                if connection is None:
+                    reused = False
+                    connection = await asyncio.wait_for(asyncio.open_connection(host,port,ssl=ssl.create_default_context() if scheme == "https" else None),self.timeout)
+                reader, writer = connection
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status, headers, response, keep_alive = await asyncio.wait_for(read_response(reader),self.timeout)
+                except (ConnectionError,asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused:
+                        continue
+                    raise ConnectionError(f"Request to {url} failed, {e}") from e
+                if keep_alive:
+                    self.idle.setdefault((scheme,host,port),[]).append(connection)
+                else:
+                    writer.close()
+                return status, headers, response
+        raise ConnectionError(f"Request to {url} failed")
+
+    async def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle.clear()
+
+
+async def read_response(reader:asyncio.StreamReader):
+    status_line = (await reader.readline()).decode("latin-1")
+    if not status_line:
+        raise ConnectionError("Connection closed before the response")
+    version, status = status_line.split(" ",2)[:2]
+    headers:dict[str,str] = dict()
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, value = line.split(":",1)
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding","").lower() == "chunked":
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0],16)
+            if size == 0:
+                await reader.readline()
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        return int(status), headers, body, False
+
+    keep_alive = headers.get("connection","").lower() != "close" and version != "HTTP/1.0"
+    return int(status), headers, body, keep_alive
+
+
+class AsyncRemoteBlaster:
+    # Runs many remote searches from a single event loop, using the NCBI BLAST URL API
+    # Submissions and polls are rate limited, throttled requests are retried with backoff,
+    # and the number of outstanding searches adapts to how fast the service responds
+    def __init__(self, url:str|None=None, max_outstanding:int=10, submit_interval:float|None=None, poll_interval:float|None=None, poll_rate:float|None=None, connections:int=4, adaptive=True, retries:int=RETRIES, backoff:float=BACKOFF, on_submit:Callable[[str,str],None]|None=None):
+        # on_submit is called with the key and RID of each submitted search
+        # The arguments left as None are read from the module constants, so they can be changed at runtime
+        if url is None:url = BLAST_URL
+        if submit_interval is None:submit_interval = SUBMIT_INTERVAL
+        if poll_interval is None:poll_interval = POLL_INTERVAL
+        if poll_rate is None:poll_rate = POLL_RATE
+        self.url = url
+        self.on_submit = on_submit
+        self.poll_interval = poll_interval
+        self.session = HttpSession(connections=connections)
+        self.submits = TokenBucket(1/submit_interval if submit_interval > 0 else float("inf"))
+        self.polls = TokenBucket(poll_rate,capacity=poll_rate)
+        self.outstanding = AdaptiveLimit(max_outstanding,maximum=MAX_OUTSTANDING if adaptive else max_outstanding,minimum=MIN_OUTSTANDING if adaptive else max_outstanding)
+        self.retries = retries
+        self.backoff = backoff
+
+    async def request(self, bucket:TokenBucket, method:str, url:str, data:dict|None=None, observe=True):
+        # Rate limited request, which is retried with exponential backoff while throttled
+        # observe=False leaves its latency out of the adaptive limit, for requests whose time depends on the size of the response
+        delays = backoff_delays(self.retries,self.backoff)
+        while True:
+            await bucket.acquire()
+            t = time.monotonic()
+            retry_after = 0
+            try:
+                status, headers, body = await self.session.request(method,url,data)
+                if status in THROTTLED_STATUSES or re.search(rb"[Bb]usy|[Tt]ry again later",body[:4096]):
+                    if headers.get("retry-after","").isdigit():retry_after = int(headers["retry-after"])
+                    raise Throttled(f"status {status}")
+            except (Throttled,ConnectionError,asyncio.TimeoutError) as e:
+                self.outstanding.decrease()
+                delay = next(delays,None)
+                if delay is None:
+                    raise
+                delay = max(delay,retry_after)
+                print(f"[!] Request was throttled or failed with `{e}`, retrying in {delay:0.0f} seconds")
+                await asyncio.sleep(delay)
+                continue
+            if observe:
+                self.outstanding.observe(time.monotonic()-t)
+            return status, headers, body
+
+    async def submit(self, query:str, params:SearchParams):
+        # Submits the search and returns its RID and estimated time in seconds until it is done
+        data = {
+            "CMD":"Put",
+            "PROGRAM":params.program,
+            "DATABASE":params.db,
+            "QUERY":query,
+            "HITLIST_SIZE":50,
+            "EXPECT":10.0,
+            "TOOL":NCBIWWW.tool,
+        }
+        if params.megablast:data["MEGABLAST"] = "on"
+        if NCBIWWW.email is not None:data["EMAIL"] = NCBIWWW.email
+        status, _, body = await self.request(self.submits,"POST",self.url,data)
+        page = body.decode(errors="replace")
+        rid = re.search(r"RID = (\S+)",page)
+        rtoe = re.search(r"RTOE = (\d+)",page)
+        if status != 200 or rid is None:
+            raise ValueError(f"Submission failed with status {status}, no RID in the response")
+        return rid.group(1), int(rtoe.group(1)) if rtoe else 0
+
+    async def poll(self, rid:str):
+        # Returns the status of the search, WAITING, READY, FAILED or UNKNOWN
+        _, _, body = await self.request(self.polls,"GET",f"{self.url}?{urllib.parse.urlencode({'CMD':'Get','RID':rid,'FORMAT_OBJECT':'SearchInfo'})}")
+        status = re.search(r"Status=(\w+)",body.decode(errors="replace"))
+        return status.group(1) if status else "UNKNOWN"
+
+    async def fetch(self, rid:str):
+        # Returns the xml of a finished search
+        # Results are megabytes, where the polls are a few bytes, so their download time says nothing about how busy the service is
+        _, _, body = await self.request(self.polls,"GET",f"{self.url}?{urllib.parse.urlencode({'CMD':'Get','RID':rid,'FORMAT_TYPE':'XML','ALIGNMENTS':500,'DESCRIPTIONS':500})}",observe=False)
+        return body.decode()
+
+    async def wait(self, rid:str, rtoe:float=0):
+        # Polls the search until it is done
+        await asyncio.sleep(min(rtoe,self.poll_interval))
+        while True:
+            status = await self.poll(rid)
+            if status == "READY":
+                return
+            if status in ("FAILED","UNKNOWN"):
+                raise ValueError(f"Search with RID {rid} has status {status}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def search(self, key:str, query:str, params:SearchParams, rid:str|None=None):
+        # A search submitted by an earlier run is polled by its RID, and only submitted again if the RID has failed or expired
+        if rid is not None:
+            print(f"[.] {key} Resuming RID {rid}")
+            try:
+                await self.wait(rid)
+                return key, await self.fetch(rid)
+            except ValueError as e:
+                print(f"[!] {key} {e}, submitting it again")
+        t = time.perf_counter()
+        rid, rtoe = await self.submit(query,params)
+        metrics.record("remote_submit",key,time.perf_counter()-t,rid=rid)
+        if self.on_submit is not None:
+            self.on_submit(key,rid)
+        print(f"[.] {key} Submitted with RID {rid}, estimated {rtoe} seconds")
+        t = time.perf_counter()
+        await self.wait(rid,rtoe)
+        metrics.record("remote_wait",key,time.perf_counter()-t,rid=rid,rtoe=rtoe)
+        t = time.perf_counter()
+        xml = await self.fetch(rid)
+        metrics.record("remote_fetch",key,time.perf_counter()-t,rid=rid,size=len(xml))
+        return key, xml
+
+    async def attempt(self, key:str, query:str, params:SearchParams, rid:str|None=None):
+        # Like search, but returns (key, xml, error), so one failed search doesn't stop the others
+        try:
+            key, xml = await self.search(key,query,params,rid)
+            return key, xml, None
+        except Exception as e:
+            print(f"[!] {key} Search failed with `{e}`")
+            return key, None, e
+
+    async def run(self, queries:Iterable[tuple[str,str|None,str|None]], params:SearchParams) -> AsyncIterator[tuple[str,str|None,Exception|None]]:
+        # Searches all (key, query, rid) triples, and yields (key, xml, error) as each search finishes, xml is None if it failed
+        # rid is None for new searches, or the RID of a search which is already submitted
+        # A key without a query needs no search, and is yielded back as (key, None, None) right away
+        tasks:set[asyncio.Task] = set()
+        for key, query, rid in queries:
+            if query is None:
+                yield key, None, None
+                continue
+            # Don't read further ahead than the searches which may be outstanding
+            while len(tasks) >= int(self.outstanding):
+                done, tasks = await asyncio.wait(tasks,return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            tasks.add(asyncio.create_task(self.attempt(key,query,params,rid)))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks,return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+
+    async def close(self):
+        await self.session.close()
+
+
+def stream(queries:Iterable[tuple[str,str|None,str|None]], params:SearchParams, **kwargs):
+    # Runs AsyncRemoteBlaster on an event loop in a background thread, and yields (key, xml, error) as the searches finish
+    # The queries are read no further ahead than the consumer, and the searches are abandoned if the consumer stops
+    results:queue.Queue = queue.Queue(STREAM_BUFFER)
+    stopped = threading.Event()
+    done = object()
+    def put(result):
+        # Waits for room in a separate thread, so the outstanding searches go on meanwhile
+        while not stopped.is_set():
+            try:
+                results.put(result,timeout=1)
+                return
+            except queue.Full:
+                continue
+    async def main():
+        remote_blaster = AsyncRemoteBlaster(**kwargs)
+        try:
+            async for result in remote_blaster.run(queries,params):
+                await asyncio.get_running_loop().run_in_executor(None,put,result)
+                if stopped.is_set():
+                    break
+        finally:
+            await remote_blaster.close()
+    def worker():
+        try:
+            asyncio.run(main())
+        except BaseException as e:
+            put(e)
+        finally:
+            put(done)
+    threading.Thread(target=worker,daemon=True).start()
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                return
+            if isinstance(result,BaseException):
+                raise result
+            yield result
+    finally:
+        stopped.set()
@@ -0,0 +1,35 @@
+import json
+import csv
+import io
+
+from blaster import summary_values
+
+# The formats a ResultWriter can write
+FORMATS = ("tsv","csv","jsonl")
+# query is the number of the sequence in the input, starting at 1, and checksum its MD5 sum, as used by the cache
+# subject_length is the length of the whole hit sequence, not of the alignment
+COLUMNS = ("query","checksum","query_length","accession","query_coverage","identity","subject_length","title")
+
+
+class ResultWriter:
+    # Writes a row per hit of each summary from blaster.summary_batch or blaster.blast_summaries to one open file
+    # The file should be buffered, it is written a row at a time, and a header is written if the file is empty
+    def __init__(self, file:io.TextIOBase, output_format="tsv", number_of_alignments:int=1, max_high_scoring_pairs:int=1):
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}', expected one of {', '.join(FORMATS)}")
+        self.file = file
+        self.output_format = output_format
+        self.number_of_alignments = number_of_alignments
+        self.max_high_scoring_pairs = max_high_scoring_pairs
+        self.writer = csv.writer(file,delimiter="\t" if output_format == "tsv" else ",",lineterminator="\n") if output_format != "jsonl" else None
+        if self.writer is not None and file.tell() == 0:
+            self.writer.writerow(COLUMNS)
+
+    def write(self, position:int, query_sequence:str, md5_checksum:str, summary:tuple):
+        query_length = summary[0] if summary[0] is not None else len(query_sequence)
+        for acc, coverage, identity, subject_length, title in summary_values(summary,self.number_of_alignments,self.max_high_scoring_pairs):
+            row = (position+1, md5_checksum, query_length, acc, round(coverage,2) if coverage is not None else None, round(identity,2) if identity is not None else None, subject_length, title)
+            if self.writer is None:
+                self.file.write(json.dumps(dict(zip(COLUMNS,row)))+"\n")
+            else:
+                self.writer.writerow(row)
@@ -0,0 +1,125 @@
+import hashlib
+import tarfile
+import random
+import gzip
+import io
+import time
+import sys
+import os
+
+# Synthetic sequences and blast results for benchmark.py, and a stand-in for blastn
+# Only the standard library is imported, so the stub blastn starts quickly
+# Usage as blastn: python synthetic_data.py blastn -outfmt 5 [-query file] [-out file]
+
+BASES = "ACGT"
+
+
+def random_sequence(rng:random.Random, length:int):
+    return "".join(rng.choices(BASES,k=length))
+
+
+def write_fasta(path:str, sequences:list[str], line_length:int=70):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path,"wt") as f:
+        for i,sequence in enumerate(sequences):
+            f.write(f">sequence_{i}\n")
+            for j in range(0,len(sequence),line_length):
+                f.write(sequence[j:j+line_length]+"\n")
+
+
+def write_fastq(path:str, sequences:list[str]):
+    with open(path,"w") as f:
+        for i,sequence in enumerate(sequences):
+            f.write(f"@sequence_{i}\n{sequence}\n+\n{'I'*len(sequence)}\n")
+
+
+def synthetic_xml(queries:list[tuple[str,int]], hits:int=10, hsps:int=2, seed:int=0):
+    # Blast xml with an iteration per (name, length) query, each with hits hits of hsps hsps at random positions
+    rng = random.Random(seed)
+    iterations = []
+    for n,(name,length) in enumerate(queries,1):
+        hit_elements = []
+        for k in range(hits):
+            hsp_elements = []
+            for h in range(hsps):
+                start = rng.randint(1,max(1,length-10))
+                end = rng.randint(start,length)
+                align_length = end-start+1
+                identity = rng.randint(align_length*8//10,align_length)
+                hsp_elements.append(
+                    f"<Hsp><Hsp_num>{h+1}</Hsp_num><Hsp_bit-score>{identity*1.8:0.1f}</Hsp_bit-score><Hsp_score>{identity}</Hsp_score><Hsp_evalue>1e-{rng.randint(5,100)}</Hsp_evalue>"
+                    f"<Hsp_query-from>{start}</Hsp_query-from><Hsp_query-to>{end}</Hsp_query-to><Hsp_hit-from>{start}</Hsp_hit-from><Hsp_hit-to>{end}</Hsp_hit-to>"
+                    f"<Hsp_query-frame>1</Hsp_query-frame><Hsp_hit-frame>1</Hsp_hit-frame><Hsp_identity>{identity}</Hsp_identity><Hsp_positive>{identity}</Hsp_positive><Hsp_gaps>0</Hsp_gaps>"
+                    f"<Hsp_align-len>{align_length}</Hsp_align-len><Hsp_qseq>A</Hsp_qseq><Hsp_hseq>A</Hsp_hseq><Hsp_midline>|</Hsp_midline></Hsp>")
+            hit_elements.append(
+                f"<Hit><Hit_num>{k+1}</Hit_num><Hit_id>gi|{k}|gb|SYN{n:05d}{k:03d}.1|</Hit_id><Hit_def>Synthetic sequence {n} {k}</Hit_def><Hit_accession>SYN{n:05d}{k:03d}</Hit_accession>"
+                f"<Hit_len>{length*2}</Hit_len><Hit_hsps>{''.join(hsp_elements)}</Hit_hsps></Hit>")
+        iterations.append(
+            f"<Iteration>\n<Iteration_iter-num>{n}</Iteration_iter-num>\n<Iteration_query-ID>Query_{n}</Iteration_query-ID>\n<Iteration_query-def>{name}</Iteration_query-def>\n<Iteration_query-len>{length}</Iteration_query-len>\n"
+            f"<Iteration_hits>{''.join(hit_elements)}</Iteration_hits>\n"
+            "<Iteration_stat><Statistics><Statistics_db-num>1</Statistics_db-num><Statistics_db-len>1</Statistics_db-len><Statistics_hsp-len>0</Statistics_hsp-len><Statistics_eff-space>0</Statistics_eff-space><Statistics_kappa>0.41</Statistics_kappa><Statistics_lambda>0.625</Statistics_lambda><Statistics_entropy>0.78</Statistics_entropy></Statistics></Iteration_stat>\n</Iteration>")
+    return (
+        '<?xml version="1.0"?>\n<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">\n<BlastOutput>\n'
+        f"<BlastOutput_program>blastn</BlastOutput_program>\n<BlastOutput_version>BLASTN 2.15.0+</BlastOutput_version>\n<BlastOutput_reference>synthetic</BlastOutput_reference>\n<BlastOutput_db>synthetic</BlastOutput_db>\n"
+        f"<BlastOutput_query-ID>Query_1</BlastOutput_query-ID>\n<BlastOutput_query-def>{queries[0][0]}</BlastOutput_query-def>\n<BlastOutput_query-len>{queries[0][1]}</BlastOutput_query-len>\n"
+        "<BlastOutput_param><Parameters><Parameters_expect>10</Parameters_expect><Parameters_sc-match>1</Parameters_sc-match><Parameters_sc-mismatch>-2</Parameters_sc-mismatch><Parameters_gap-open>0</Parameters_gap-open><Parameters_gap-extend>0</Parameters_gap-extend><Parameters_filter>L;m;</Parameters_filter></Parameters></BlastOutput_param>\n"
+        f"<BlastOutput_iterations>\n{chr(10).join(iterations)}\n</BlastOutput_iterations>\n</BlastOutput>\n")
+
+
+def synthetic_tabular(queries:list[tuple[str,int]], hits:int=10, hsps:int=2, seed:int=0):
+    # Rows in the blaster.TABULAR_OUTFMT format, for the same searches as synthetic_xml
+    rng = random.Random(seed)
+    rows = []
+    for n,(name,length) in enumerate(queries,1):
+        for k in range(hits):
+            for h in range(hsps):
+                start = rng.randint(1,max(1,length-10))
+                end = rng.randint(start,length)
+                rows.append(f"{name}\tSYN{n:05d}{k:03d}.1\t{rng.randint((end-start+1)*8//10,end-start+1)}\t{end-start+1}\t{start}\t{end}\t{length*2}\tSynthetic sequence {n} {k}\n")
+    return "".join(rows)
+
+
+def synthetic_volume(name:str, size:int, seed:int=0):
+    # A gzipped tar of the files of a db volume, size random bytes split over them, like a volume of the NCBI blast db folder
+    rng = random.Random(seed)
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data,mode="w:gz") as f:
+        for extension,share in ((".nsq",0.6),(".nhr",0.3),(".nin",0.1)):
+            content = rng.randbytes(int(size*share))
+            info = tarfile.TarInfo(name+extension)
+            info.size = len(content)
+            f.addfile(info,io.BytesIO(content))
+    return data.getvalue()
+
+
+def read_fasta_queries(fasta:str):
+    # Returns (name, length) of each query in the fasta
+    queries = []
+    for record in fasta.split(">")[1:]:
+        name, _, sequence = record.partition("\n")
+        queries.append((name.split()[0] if name.strip() else f"Query_{len(queries)+1}",len(sequence.replace("\n",""))))
+    return queries
+
+
+def stub_blastn(args:list[str]):
+    # Stands in for blastn, reads the queries from -query or stdin, and writes synthetic results to -out or stdout
+    # BENCHMARK_BLASTN_LATENCY is the seconds each invocation takes, and BENCHMARK_HITS and BENCHMARK_HSPS the size of the results
+    options = dict(zip(args[::2],args[1::2]))
+    fasta = open(options["-query"]).read() if "-query" in options else sys.stdin.read()
+    queries = read_fasta_queries(fasta) or [("Query_1",len(fasta.strip()))]
+    time.sleep(float(os.environ.get("BENCHMARK_BLASTN_LATENCY","0")))
+    hits, hsps = int(os.environ.get("BENCHMARK_HITS","10")), int(os.environ.get("BENCHMARK_HSPS","2"))
+    seed = int(hashlib.md5(fasta.encode()).hexdigest()[:8],16)
+    if options.get("-outfmt","5").strip('"').startswith("6"):
+        result = synthetic_tabular(queries,hits,hsps,seed)
+    else:
+        result = synthetic_xml(queries,hits,hsps,seed)
+    if "-out" in options:
+        with open(options["-out"],"w") as f:f.write(result)
+    else:
+        sys.stdout.write(result)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["blastn"]:
+        stub_blastn(sys.argv[2:])